@@ -0,0 +1,58 @@
+import os
+import shutil
+import threading
+from cache import CACHE_PATH, MISSING, SQLiteCache
+from metrics import metrics
+
+
+# Seconds a download's content hash is remembered for
+STORE_TTL = 365 * 24 * 60 * 60
+
+
+class AudioStore:
+    """Transcodes downloads through `transcoder`, reusing the mp3 of any identical earlier download.
+
+    Different videos (and retries of the same song) often serve byte-identical
+    streams.  Each download is keyed by the hash of its bytes (as computed by
+    download_file), and the store remembers which mp3 that content was first
+    transcoded to.  When the same content turns up again, that mp3 is copied into
+    place instead of being transcoded again.  It is copied rather than hard-linked
+    because each copy gets its own song's tags, and tagging a hard link would
+    rewrite the original too.
+
+    Entries whose mp3 has since been moved or deleted are transcoded afresh.
+    Downloads with the same hash wait for each other, so concurrent duplicates
+    are only transcoded once.  Callers that go on to tag the mp3 should hold
+    `lock_for(digest)` until they are done, so a duplicate is never copied from
+    a file that is halfway through being retagged.
+    """
+
+    def __init__(self, transcoder, ttl=STORE_TTL, path=CACHE_PATH):
+        self.transcoder = transcoder
+        self.index = SQLiteCache('audio_store', ttl=ttl, path=path)
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    # Lock held while the mp3 for `digest` is produced (and tagged, by the caller)
+    # (Reentrant, so a caller holding it can still call transcode)
+    def lock_for(self, digest):
+        with self.lock:
+            return self.locks.setdefault(digest, threading.RLock())
+
+    # Produce `destination` from the download at `source` whose content hash is `digest`.
+    # Returns whether an existing mp3 was reused instead of transcoding.
+    def transcode(self, source, destination, digest):
+        with self.lock_for(digest):
+            existing = self.index.get(digest)
+            if existing is not MISSING and os.path.exists(existing):
+                if existing != destination:
+                    partPath = destination + '.part'
+                    shutil.copyfile(existing, partPath)
+                    os.replace(partPath, destination)
+                metrics.increment('audio_store_total', result='reused')
+                return True
+
+            self.transcoder.transcode(source, destination)
+            self.index.set(digest, destination)
+            metrics.increment('audio_store_total', result='transcoded')
+            return False
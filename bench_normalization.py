@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Micro-benchmark for normalization.convert_to_slug and convert_duration against the
+# original per-call implementations.  Uses the track/artist pairs in songRecords.json
+# when it is present, otherwise a built-in sample of real station plays.
+#
+#   python bench_normalization.py [repeat]
+
+import json
+import os
+import re
+import sys
+import timeit
+
+import normalization
+
+
+SAMPLE_PLAYS = [
+    ("Sisyphus", "Andrew Bird"),
+    ("The Less I Know the Better", "Tame Impala"),
+    ("Take Me to the River", "Talking Heads"),
+    ("Heads Will Roll", "Yeah Yeah Yeahs"),
+    ("Once in a Lifetime", "Talking Heads"),
+    ("Seven Nation Army", "The White Stripes"),
+    ("Everybody Wants to Rule the World", "Tears for Fears"),
+    ("Mr. Brightside", "The Killers"),
+    ("Don't Stop Me Now", "Queen"),
+    ("Float On", "Modest Mouse"),
+    ("Reptilia", "The Strokes"),
+    ("Bad Guy", "Billie Eilish"),
+    ("Nightcall", "Kavinsky"),
+    ("Feel It Still", "Portugal. The Man"),
+    ("Motion Sickness", "Phoebe Bridgers"),
+    ("Señorita", "Shawn Mendes & Camila Cabello"),
+    ("Kids (Remastered 2019)", "MGMT"),
+    ("Redbone", "Childish Gambino"),
+    ("Ain't No Sunshine", "Bill Withers"),
+    ("Dreams - 2004 Remaster", "Fleetwood Mac"),
+    ("1979", "The Smashing Pumpkins"),
+    ("Such Great Heights", "The Postal Service"),
+    ("Holocene", "Bon Iver"),
+    ("Breezeblocks", "alt-J"),
+    ("Little Dark Age", "MGMT"),
+    ("Electric Feel", "MGMT"),
+    ("Do I Wanna Know?", "Arctic Monkeys"),
+    ("Pumped Up Kicks", "Foster the People"),
+    ("Gooey", "Glass Animals"),
+    ("Sweater Weather", "The Neighbourhood"),
+]
+
+SAMPLE_DURATIONS = ["3:45", "04:12", "1:02:33", "215", "0:59", "12:00", "n/a"]
+
+
+def legacy_convert_duration(duration):
+    pattern = re.compile('(\\d+)')
+    groups = re.findall(pattern, duration)
+
+    if (len(groups) not in [1,2,3]):
+        return None
+
+    seconds = 0
+    for i, x in enumerate(groups):
+        multiplier = 60 ** (len(groups) - 1 - i)
+        seconds += int(x) * multiplier
+    return seconds
+
+
+def legacy_convert_to_slug(track, artist):
+    track = track.lower()
+    track = re.sub(r'(?<!\w)the(?!\w)', '', track)
+    track = re.sub(r'[^a-zA-Z0-9]', '', track)
+    track = track[:20]
+
+    artist = artist.lower()
+    artist = re.sub(r'(?<!\w)the(?!\w)', '', artist)
+    artist = re.sub(r'[^a-zA-Z0-9]', '', artist)
+    artist = artist[:20]
+
+    return track + artist
+
+
+def load_plays():
+    if not os.path.exists('songRecords.json'):
+        return SAMPLE_PLAYS
+    with open('songRecords.json') as json_file:
+        recordList = json.load(json_file)
+    return [(song['trackName'], song['artistName']) for song in recordList
+            if song.get('trackName') is not None and song.get('artistName') is not None]
+
+
+def bench(label, func, items, repeat):
+    seconds = min(timeit.repeat(lambda: [func(*item) for item in items], number=1, repeat=repeat))
+    print("{:<28} {:>10.3f} ms  {:>8.2f} us/call".format(label, seconds * 1000, seconds * 1e6 / len(items)))
+    return seconds
+
+
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    plays = load_plays()
+    durations = [(d,) for d in SAMPLE_DURATIONS] * 1000
+
+    # Both implementations must agree before their timings mean anything
+    for track, artist in plays:
+        assert normalization.convert_to_slug(track, artist) == legacy_convert_to_slug(track, artist), (track, artist)
+    for (duration,) in durations:
+        assert normalization.convert_duration(duration) == legacy_convert_duration(duration), duration
+
+    print("{} plays, {} durations, best of {}".format(len(plays), len(durations), repeat))
+    legacy = bench("legacy convert_to_slug", legacy_convert_to_slug, plays, repeat)
+    normalization.slug_part.cache_clear()
+    cold = bench("convert_to_slug (cold)", lambda t, a: (normalization.slug_part.cache_clear(), normalization.convert_to_slug(t, a)), plays, repeat)
+    warm = bench("convert_to_slug (warm)", normalization.convert_to_slug, plays, repeat)
+    print("speedup: {:.1f}x cold, {:.1f}x warm".format(legacy / cold, legacy / warm))
+
+    legacy = bench("legacy convert_duration", legacy_convert_duration, durations, repeat)
+    new = bench("convert_duration", normalization.convert_duration, durations, repeat)
+    print("speedup: {:.1f}x".format(legacy / new))
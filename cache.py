@@ -0,0 +1,77 @@
+import json
+import sqlite3
+import threading
+import time
+import urllib.parse
+from metrics import metrics
+
+
+# Local file shared by every cache (each cache gets its own table)
+CACHE_PATH = 'cache.sqlite'
+
+# Returned by `get` when there is no live entry, since None is a value that can be cached
+MISSING = object()
+
+
+# Seconds until a signed URL's expire= timestamp (less a safety margin), or `default` if it has none
+def url_ttl(url, default, margin=300):
+    expire = urllib.parse.parse_qs(urllib.parse.urlparse(url).query).get('expire')
+    if expire and expire[0].isdigit():
+        return max(int(expire[0]) - time.time() - margin, 0)
+    return default
+
+
+class SQLiteCache:
+    """Persistent key/value cache with per-entry expiry, kept in a local SQLite file.
+
+    Values are stored as JSON, so a cached None (e.g. a remembered failure) can be
+    told apart from a miss.  Entries older than `ttl` seconds (or the ttl passed to
+    `set`) are ignored and cleared out when the cache is first used.  Each thread
+    gets its own connection, so the cache can be shared by worker threads.
+
+    Nothing is opened until the first lookup, so a script can define its caches at
+    import time without leaving a cache file wherever it happens to be imported.
+    """
+
+    def __init__(self, name, ttl, path=CACHE_PATH):
+        self.name = name
+        self.ttl = ttl
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.ready = False
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self.local.connection = connection
+
+            # (The first connection creates the table and clears out expired entries)
+            with self.lock:
+                if not self.ready:
+                    with connection:
+                        connection.execute('CREATE TABLE IF NOT EXISTS "{}" (key TEXT PRIMARY KEY, value TEXT, expires REAL)'.format(self.name))
+                        connection.execute('DELETE FROM "{}" WHERE expires < ?'.format(self.name), (time.time(),))
+                    self.ready = True
+        return connection
+
+    def get(self, key):
+        row = self.connection().execute(
+            'SELECT value FROM "{}" WHERE key = ? AND expires >= ?'.format(self.name), (key, time.time())
+        ).fetchone()
+        metrics.increment('cache_lookups_total', cache=self.name, result='hit' if row else 'miss')
+        return json.loads(row[0]) if row else MISSING
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self.connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO "{}" (key, value, expires) VALUES (?, ?, ?)'.format(self.name),
+                (key, json.dumps(value), expires),
+            )
+
+    def delete(self, key):
+        with self.connection() as connection:
+            connection.execute('DELETE FROM "{}" WHERE key = ?'.format(self.name), (key,))
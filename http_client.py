@@ -0,0 +1,249 @@
+import os
+import random
+import re
+import requests
+import threading
+import time
+import urllib.parse
+from metrics import metrics
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Bytes read from the socket and written to disk at a time
+CHUNK_SIZE = 64 * 1024
+
+# Seconds to wait for a connection or for the next bytes of a response
+DEFAULT_TIMEOUT = 30
+
+# Responses worth retrying after a pause
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# Responses meaning the host wants fewer requests; these slow down its rate limiter
+THROTTLE_STATUSES = [429, 503]
+
+
+# Seconds to wait before retry number `attempt` (counting from 0): exponential backoff
+# with full jitter, so workers that failed together don't all retry together
+def backoff_delay(attempt, factor=0.5, maximum=60):
+    return random.uniform(0, min(maximum, factor * 2 ** attempt))
+
+
+# Seconds asked for by a Retry-After header, if it holds a number of seconds
+def retry_after(headers):
+    value = (headers or {}).get('Retry-After')
+    if value and value.strip().isdigit():
+        return int(value)
+    return None
+
+
+class JitteredRetry(Retry):
+    """urllib3 Retry whose backoff uses backoff_delay instead of a fixed doubling sequence."""
+
+    def get_backoff_time(self):
+        retries = len([h for h in self.history if h.status is None or h.status in RETRY_STATUSES])
+        if retries <= 1:
+            return 0
+        return backoff_delay(retries - 1, factor=self.backoff_factor)
+
+
+class TokenBucket:
+    """Token bucket for one host whose rate adapts to how the host responds.
+
+    Each request takes a token; tokens refill at `rate` per second up to `capacity`.
+    Successful responses nudge the rate up by `increase` (to at most `max_rate`),
+    and throttling responses halve it (to at least `min_rate`) and empty the bucket,
+    so throughput settles at about what the host allows.  A Retry-After pauses the
+    bucket entirely until that time has passed.
+    """
+
+    def __init__(self, rate, capacity, min_rate=0.1, max_rate=50, increase=0.05):
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Wait until a request may be sent
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttled(self, retry_after=None):
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+
+class RateLimiter:
+    """One TokenBucket per host, shared by every thread making requests."""
+
+    def __init__(self, rate=5, capacity=5, **options):
+        self.rate = rate
+        self.capacity = capacity
+        self.options = options
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, url):
+        host = urllib.parse.urlsplit(url).hostname
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.capacity, **self.options)
+            return self.buckets[host]
+
+
+class HTTPSession(requests.Session):
+    """requests.Session shared by every thread in a script.
+
+    Keeps a pool of keep-alive connections per host (up to `pool_size` each, so
+    every worker thread can hold one), gives every request a default timeout, and
+    paces requests to each host with an adaptive RateLimiter.  429 and 503
+    responses slow the host's bucket down (pausing it for any Retry-After) and are
+    retried through it; connection errors and other 5xx responses are retried with
+    jittered exponential backoff.  Once retries run out the last response is
+    returned as usual.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=3, pool_size=16, limiter=None):
+        super().__init__()
+        self.timeout = timeout
+        self.retries = retries
+        self.limiter = limiter or RateLimiter()
+        retry = JitteredRetry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=[status for status in RETRY_STATUSES if status not in THROTTLE_STATUSES],
+            raise_on_status=False,
+            # (urllib3 would otherwise retry 429/503 responses that carry a Retry-After itself,
+            # sleeping in the worker without the host's bucket ever hearing about it)
+            respect_retry_after_header=False,
+        )
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_size, max_retries=retry)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        bucket = self.limiter.bucket(url)
+
+        host = urllib.parse.urlsplit(url).hostname
+        for attempt in range(self.retries + 1):
+            bucket.acquire()
+            with metrics.timer('http_request_seconds', host=host):
+                response = super().request(method, url, **kwargs)
+            metrics.increment('http_responses_total', host=host, status=response.status_code)
+            if response.status_code not in THROTTLE_STATUSES:
+                bucket.succeeded()
+                return response
+
+            bucket.throttled(retry_after(response.headers))
+            if attempt < self.retries:
+                response.close()
+        return response
+
+
+# The session every script makes its requests through
+client = HTTPSession()
+
+
+# Expected size of the whole file, from a 200's Content-Length or a 206's Content-Range
+def expected_size(response):
+    if response.status_code == 206:
+        match = re.match(r'bytes \d+-\d+/(\d+)', response.headers.get('Content-Range', ''))
+        return int(match.group(1)) if match else None
+    length = response.headers.get('Content-Length')
+    return int(length) if length else None
+
+
+def download_file(url, path, attempts=4, timeout=DEFAULT_TIMEOUT, hasher=None):
+    """Stream `url` to `path` in chunks, resuming with Range requests if the connection drops.
+
+    Data goes to `path` + '.part' and is renamed to `path` only once the size matches
+    what the server announced, so a partial download never looks like a finished one.
+    Raises IOError if the file is still incomplete after `attempts` tries.
+
+    If a hashlib object is given as `hasher` (e.g. hashlib.sha256()), it is fed the
+    file's bytes as they are written, so the digest is ready without reading the
+    file back.
+    """
+    partPath = path + '.part'
+
+    # (A leftover part file belongs to an earlier, possibly expired, stream URL)
+    if os.path.exists(partPath):
+        os.remove(partPath)
+
+    total = None
+    error = None
+    for attempt in range(attempts):
+        received = os.path.getsize(partPath) if os.path.exists(partPath) else 0
+        headers = {'Range': 'bytes={}-'.format(received)} if received else {}
+
+        try:
+            with client.get(url, headers=headers, stream=True, timeout=timeout, allow_redirects=True) as response:
+                # (Nothing left to send: the previous attempt had in fact finished)
+                if response.status_code == 416 and received and received == total:
+                    break
+                response.raise_for_status()
+
+                # (The server ignored the Range header and is sending the whole file again;
+                # the bytes already on disk are skipped, so the file is only ever appended to)
+                skip = received if received and response.status_code != 206 else 0
+
+                total = expected_size(response) or total
+                with open(partPath, 'ab' if received else 'wb') as file:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        if skip:
+                            chunk, skip = chunk[skip:], max(skip - len(chunk), 0)
+                        if not chunk:
+                            continue
+                        file.write(chunk)
+                        metrics.increment('download_bytes_total', len(chunk))
+                        if hasher is not None:
+                            hasher.update(chunk)
+
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            error = e
+            continue
+
+        size = os.path.getsize(partPath)
+        if total is None or size == total:
+            break
+        if size > total:
+            os.remove(partPath)
+            raise IOError("Downloaded {} bytes but expected {} from {}".format(size, total, url))
+        error = IOError("Connection closed after {} of {} bytes".format(size, total))
+
+    else:
+        if os.path.exists(partPath):
+            os.remove(partPath)
+        raise IOError("Download failed after {} attempts: {}".format(attempts, error))
+
+    os.replace(partPath, path)
+    return path
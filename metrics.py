@@ -0,0 +1,153 @@
+import bisect
+import http.server
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+
+def label_string(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels) + '}'
+
+
+class Metrics:
+    """Counters and latency histograms shared by every thread in a script.
+
+    Each metric is identified by a name and a set of labels (e.g.
+    `observe('pipeline_stage_seconds', 1.2, stage='download')`).  A run's
+    metrics can be written out as a JSON summary or in the Prometheus text
+    format, and long-running scripts can serve the Prometheus format live.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'max': 0.0}
+            histogram['counts'][bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram['sum'] += seconds
+            histogram['max'] = max(histogram['max'], seconds)
+
+    # Time the body of a with statement into a histogram
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    # Estimate a quantile from a histogram's bucket counts (the upper bound of its bucket)
+    def quantile(self, histogram, q):
+        total = sum(histogram['counts'])
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.buckets + [histogram['max']], histogram['counts']):
+            seen += count
+            if seen >= rank:
+                return min(bound, histogram['max'])
+
+    def summary(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: dict(histogram, counts=list(histogram['counts'])) for key, histogram in self.histograms.items()}
+
+        summary = {'started': self.started, 'seconds': time.time() - self.started, 'counters': [], 'histograms': []}
+        for (name, labels), value in sorted(counters.items()):
+            summary['counters'].append({'name': name, 'labels': dict(labels), 'value': value})
+        for (name, labels), histogram in sorted(histograms.items()):
+            count = sum(histogram['counts'])
+            summary['histograms'].append({
+                'name': name,
+                'labels': dict(labels),
+                'count': count,
+                'sum': histogram['sum'],
+                'mean': histogram['sum'] / count if count else None,
+                'p50': self.quantile(histogram, 0.5),
+                'p95': self.quantile(histogram, 0.95),
+                'max': histogram['max'],
+            })
+        return summary
+
+    def prometheus(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: dict(histogram, counts=list(histogram['counts'])) for key, histogram in self.histograms.items()}
+
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                lines.append('# TYPE {} counter'.format(name))
+                typed.add(name)
+            lines.append('{}{} {}'.format(name, label_string(labels), value))
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name not in typed:
+                lines.append('# TYPE {} histogram'.format(name))
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ['+Inf'], histogram['counts']):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, label_string(labels + (('le', bound),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, label_string(labels), histogram['sum']))
+            lines.append('{}_count{} {}'.format(name, label_string(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+    # Write the metrics to `path`, as JSON if it ends in .json and in the Prometheus text format otherwise
+    # (Written under a temporary name and renamed, so a collector never reads half a file)
+    def write(self, path):
+        text = json.dumps(self.summary(), indent=2) if path.endswith('.json') else self.prometheus()
+        partPath = path + '.part'
+        with open(partPath, 'w') as file:
+            file.write(text)
+        os.replace(partPath, path)
+
+    # Serve the Prometheus text format at http://<host>:<port>/metrics from a background thread
+    def serve(self, port, host=''):
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        return server
+
+
+# The metrics every module records into
+metrics = Metrics()
@@ -1,23 +1,39 @@
 import concurrent.futures
 import configparser
+import hashlib
 import json
 import logging
 import os
-import random
 import re
-import requests
 import threading
-import time
 import urllib.parse
+from audio_store import AudioStore
+from cache import MISSING, SQLiteCache, url_ttl
 from datetime import date, datetime, timedelta
+from http_client import client, download_file
+from metrics import metrics
 from lxml import html
 from mutagen.easyid3 import EasyID3
-from pydub import AudioSegment
+from normalization import convert_to_slug
+from pipeline import Pipeline
+from record_store import RecordStore
+from transcoder import Transcoder
 from urllib.request import urlretrieve
+from youtube_search import search_videos
 
 
 SONG_COUNT = 20
 
+# Seconds a YouTube search result is reused for
+SEARCH_CACHE_TTL = 30 * 24 * 60 * 60
+searchCache = SQLiteCache('youtube_search', ttl=SEARCH_CACHE_TTL)
+
+# Seconds a resolved stream URL is reused for when it doesn't say when it expires,
+# and seconds to wait before asking the API again about a video it failed on
+STREAM_CACHE_TTL = 60 * 60
+STREAM_FAILURE_TTL = 15 * 60
+streamCache = SQLiteCache('stream_urls', ttl=STREAM_CACHE_TTL)
+
 
 def getQuery(song):
     queryList = []
@@ -31,15 +47,29 @@ def getQuery(song):
     return query
 
 
-def getVideoURL(query):
-    response = requests.get('https://www.youtube.com/results?search_query={}'.format(query))
-    pattern = re.compile('"videoRenderer":{"videoId":"(.*?)"')
-    match = re.search(pattern, response.text)
-    videoURL = match.group(1)
+# Searches are cached by the song's slug when one is given, so retried songs skip the search
+def getVideoURL(query, slug=None):
+    if slug is not None:
+        videoURL = searchCache.get(slug)
+        if videoURL is not MISSING:
+            return videoURL
+
+    results = search_videos(query)
+    if not results:
+        raise ValueError("No videos found for query {}".format(query))
+    videoURL = results[0][0]
+
+    if slug is not None:
+        searchCache.set(slug, videoURL)
     return videoURL
 
 
+# Resolved stream URLs are cached until they expire, and API failures for a short while
 def getDownloadURL(song):
+    downloadURL = streamCache.get(song['videoURL'])
+    if downloadURL is not MISSING:
+        return downloadURL if downloadURL else "API Failed"
+
     youtubeURL = 'https://www.youtube.com/watch?v={}'.format(song['videoURL'])
     youtubeURL = urllib.parse.quote_plus(youtubeURL)
     apiURL = 'https://getvideo.p.rapidapi.com/?url={}'.format(youtubeURL)
@@ -47,7 +77,7 @@ def getDownloadURL(song):
         "X-RapidAPI-Host": apiHost,
         "X-RapidAPI-Key": apiKey
     }
-    response = requests.get(apiURL, headers=apiHeaders)
+    response = client.get(apiURL, headers=apiHeaders)
     response = json.loads(response.text)
 
     downloadURL = None
@@ -55,42 +85,45 @@ def getDownloadURL(song):
     # API has not been working recently; check if error message returned
     status = response.get('message', None)
     if status == 'Failed to get info':
+        streamCache.set(song['videoURL'], None, ttl=STREAM_FAILURE_TTL)
         return "API Failed"
 
     # (There are several streams in the response; just grab the first one)
     downloadURL = response['streams'][0]['url']
+    streamCache.set(song['videoURL'], downloadURL, ttl=url_ttl(downloadURL, STREAM_CACHE_TTL))
     return downloadURL
 
     # If proper stream not found in response, return error
     return "Stream not found"
 
 
-def downloadSong(song, downloadURL, ):
+def fetchSong(song, downloadURL, hasher=None):
     fileName = "{} - {} - {} - {}".format(song['artistName'], song['trackName'], song['datePlayed'], song['stationName'])
     fileName = re.sub(r'[^A-Za-z0-9\s\-]', '', fileName)
     fileName += ".m4a"
 
-    with os_lock:
-        try:
-            date_string = datetime.date(datetime.now()).strftime('%Y-%m-%d')
-            directory = os.path.join(os.getcwd(), 'downloads', 'archive', date_string)
-            if not os.path.exists(directory):
-                os.makedirs(directory)
-        except Exception as e:
-            debug.error("Failed to create directory.  Error: {}".format(e))
+    date_string = datetime.date(datetime.now()).strftime('%Y-%m-%d')
+    directory = os.path.join(os.getcwd(), 'downloads', 'archive', date_string)
+    os.makedirs(directory, exist_ok=True)
 
-    r = requests.get(downloadURL, allow_redirects=True)
-    open(os.path.join(directory, fileName), 'wb').write(r.content)
+    return download_file(downloadURL, os.path.join(directory, fileName), hasher=hasher)
 
+
+# Downloads go through the audio store, which copies the mp3 of an identical earlier
+# download (same content hash) instead of transcoding again
+def transcodeSong(song, filePath, digest):
     # Set audio file metadata
-    with dub_lock:
-        time.sleep(0.5)
-        try:
-            dub_audio = AudioSegment.from_file(os.path.join(directory, fileName), "m4a")
-            newFileName = re.sub(r'm4a$', r'mp3', fileName)
-            dub_audio.export(os.path.join(directory, newFileName), "mp3")
-
-            audio = EasyID3(os.path.join(directory, newFileName))
+    try:
+        newFilePath = re.sub(r'm4a$', r'mp3', filePath)
+
+        # (The mp3 is tagged before other downloads with the same content may copy it)
+        with audioStore.lock_for(digest):
+            if audioStore.transcode(filePath, newFilePath, digest):
+                debug.info("Reused an existing mp3 for {}".format(os.path.basename(newFilePath)))
+
+            # (A reused mp3 still has the tags of the song it was made for, so those are cleared first)
+            audio = EasyID3(newFilePath)
+            audio.clear()
             audio["title"] = song["trackName"]
             audio["artist"] = song["artistName"]
             audio["album"] = song["collectionName"]
@@ -98,83 +131,116 @@ def downloadSong(song, downloadURL, ):
             audio["compilation"] = song["programName"]
             audio["genre"] = ";".join([song['stationName'], 'Scraped'])
             audio.save()
-            return "dub success"
+        return "dub success"
 
-        except Exception as e:
-            debug.error("Failed to convert song from m4a to mp3.  Filename: {}.  Error: {}".format(fileName, e))
-            return "dub failure"
+    except Exception as e:
+        debug.error("Failed to convert song from m4a to mp3.  Filename: {}.  Error: {}".format(os.path.basename(filePath), e))
+        return "dub failure"
+
+    finally:
+        os.remove(filePath)
 
-        finally:
-            os.remove(os.path.join(directory, fileName))
-            time.sleep(0.5)
 
+# Pipeline stages for one song; each job carries the song's index and record through
+# the search, API, download and transcode stages, which all run at the same time
 
+def searchStage(job):
+    song = job['song']
+    song['query'] = getQuery(song)
 
-def getSong(index):
+    # (Reuse the video found on an earlier attempt at this song)
+    if not song.get('videoURL'):
+        slug = convert_to_slug(song['trackName'] or '', song['artistName'] or '')
+        song['videoURL'] = getVideoURL(song['query'], slug)
+    return True
+
+
+def resolveStage(job):
+    downloadURL = getDownloadURL(job['song'])
+    if downloadURL == "API Failed":
+        job['song']['outcome'] = "api-failure"
+        debug.warning("API failed to retrieve song for index: {}".format(job['index']))
+        return False
+    if downloadURL == "Stream not found":
+        job['song']['outcome'] = "api-failure"
+        debug.warning("Failed to find proper stream for song at index: {}".format(job['index']))
+        return False
+    job['downloadURL'] = downloadURL
+    return True
+
+
+def downloadStage(job):
+    hasher = hashlib.sha256()
     try:
-        debug.debug("Beginning getSong for index: {}".format(index))
-
-        song = recordList[index]
-
-        song['query'] = getQuery(song)
-        song['videoURL'] = getVideoURL(song['query'])
-
-        downloadURL = getDownloadURL(song)
-        if downloadURL == "API Failed":
-            song['outcome'] = "api-failure"
-            debug.warning("API failed to retrieve song for index: {}".format(index))
-        if downloadURL == "Stream not found":
-            song['outcome'] = "api-failure"
-            debug.warning("Failed to find proper stream for song at index: {}".format(index))
-        else:
-            result = downloadSong(song, downloadURL)
-            if result == "dub failure":
-                song['outcome'] = "dub-failure"
-            else:
-                song['outcome'] = "success"
+        job['filePath'] = fetchSong(job['song'], job['downloadURL'], hasher)
+    except Exception:
+        # (The stream URL may have gone stale; resolve it again next time)
+        streamCache.delete(job['song']['videoURL'])
+        raise
+    job['digest'] = hasher.hexdigest()
+    return True
 
-    except Exception as e:
-        song['outcome'] = "error"
-        debug.error("Problem encountered in 'getSong' function.\nError: {}\nSong: {}\n".format(e, song))
 
-    finally:
-        with lock:
-            recordList[index] = song
-        debug.debug("Finished getSong for index: {}.  Outcome: {}".format(index, song['outcome']))
+def transcodeStage(job):
+    result = transcodeSong(job['song'], job['filePath'], job['digest'])
+    if result == "dub failure":
+        job['song']['outcome'] = "dub-failure"
+    else:
+        job['song']['outcome'] = "success"
+    return True
 
 
+def songFailed(job, e):
+    job['song']['outcome'] = "error"
+    debug.error("Problem encountered in song pipeline.\nError: {}\nSong: {}\n".format(e, job['song']))
 
-def runThreads(iterable, max_workers=3, exec_func=getSong):
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        executor.map(exec_func, iterable)
 
+def songFinished(job):
+    metrics.increment('songs_total', outcome=job['song'].get('outcome', None), station=job['song'].get('stationName', None))
+    with lock:
+        recordList[job['index']] = job['song']
+    debug.debug("Finished song at index: {}.  Outcome: {}".format(job['index'], job['song'].get('outcome', None)))
 
 
-def getSongIndices(recordList):
-    song_indices = list() # Create empty list to fill with the songs that we decide worthy of capturing
+# Run one song through every pipeline stage in the calling thread
+def getSong(index):
+    job = {'index': index, 'song': recordList[index]}
+    try:
+        for stage in [searchStage, resolveStage, downloadStage, transcodeStage]:
+            if not stage(job):
+                break
+    except Exception as e:
+        songFailed(job, e)
+    finally:
+        songFinished(job)
+
+
+def runThreads(iterable, max_workers=3, exec_func=getSong):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        executor.map(exec_func, iterable)
 
-    # Shuffled list of all indexes in recordList
-    all_indices = list(range(len(recordList)))
-    random.shuffle(all_indices)
 
-    for i in all_indices:
-        song = recordList[i]
+def runPipeline(song_indices):
+    pipeline = Pipeline([
+        ('search', searchStage, 2),
+        ('resolve', resolveStage, 2),
+        ('download', downloadStage, 3),
+        ('transcode', transcodeStage, transcoder.workers),
+    ], on_done=songFinished, on_error=songFailed).start()
 
-        # Check if the song is eligible to be scraped
-        if song.get('outcome', None) in ['error', 'success']:
-            debug.debug('Skipping song because of its existing outcome.  song[outcome] = {}'.format(song.get('outcome', None)))
-            continue
-        if song.get('stationName', None) == 'KCRW':
-            debug.debug('Skipping song as station is KCRW')
-            continue
+    for index in song_indices:
+        debug.debug("Beginning song pipeline for index: {}".format(index))
+        pipeline.submit({'index': index, 'song': recordList[index]})
+    pipeline.close()
 
-        # Since the song is eligible, add it to 'song_indices'
-        song_indices.append(i)
 
-        # Check that 'song_indices' isn't longer than our SONG_COUNT constant
-        if len(song_indices) >= SONG_COUNT:
-            break
 
+# Choose up to SONG_COUNT random songs that are eligible to be scraped
+# (The record store keeps an index of eligible songs, which excludes songs with a final
+# outcome and songs from the stations listed under [scraper] excluded_stations)
+def getSongIndices(recordList):
+    song_indices = recordList.sample(SONG_COUNT)
+    debug.debug('Selected {} eligible songs: {}'.format(len(song_indices), song_indices))
     return song_indices
 
 
@@ -184,6 +250,7 @@ config = configparser.ConfigParser()
 config.read('credentials.ini')
 apiHost = str(config['credentials']['host'])
 apiKey = str(config['credentials']['key'])
+excludedStations = config.get('scraper', 'excluded_stations', fallback='KCRW').split()
 
 
 
@@ -199,22 +266,24 @@ if __name__ == '__main__':
     debug.addHandler(logging.StreamHandler())
 
     # Define locks for threading
-    os_lock = threading.Lock()
-    dub_lock = threading.Lock()
     lock = threading.Lock()
 
-    # Load record list
-    with open('songRecords.json') as json_file:
-        recordList = json.load(json_file)
+    # Set up the transcoder
+    transcoder = Transcoder.from_config(config)
+    audioStore = AudioStore(transcoder)
+
+    # Open record store (created from songRecords.json on the first run)
+    recordList = RecordStore.open('songRecords.sqlite', 'songRecords.json', excluded_stations=excludedStations)
 
     # Select songs to capture
     song_indices = getSongIndices(recordList)
 
-    # Execute getSong function within ThreadPool
-    debug.debug("Now beginning to execute ThreadPool")
-    runThreads(iterable=song_indices, max_workers=3, exec_func=getSong)
+    # Run the selected songs through the download pipeline
+    # (Each song's record is saved to the store as soon as it finishes)
+    debug.debug("Now beginning to execute pipeline")
+    runPipeline(song_indices)
 
-    # Save record list
-    debug.debug("All finished.  Now saving the updated recordList.")
-    with open('songRecords.json', 'w') as outfile:
-        json.dump(recordList, outfile)
+    # Save the run's stage timings and counters
+    metrics.write('music_scraper_metrics.json')
+    metrics.write('music_scraper_metrics.prom')
+    debug.debug("All finished.")
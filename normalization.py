@@ -0,0 +1,70 @@
+import re
+from functools import lru_cache
+
+
+# Patterns are compiled once at import rather than on every call
+THE_PATTERN = re.compile(r'(?<!\w)the(?!\w)')
+NON_ALNUM_PATTERN = re.compile(r'[^a-z0-9]')
+DIGITS_PATTERN = re.compile(r'\d+')
+
+
+# Convert time string to int of seconds
+def convert_duration(duration):
+    groups = DIGITS_PATTERN.findall(duration)
+
+    # Check that the duration appears to be a parsable value
+    if (len(groups) not in [1,2,3]):
+        return None
+
+    seconds = 0
+    for x in groups:
+        seconds = seconds * 60 + int(x)
+    return seconds
+
+
+# Lowercase, drop the word "the" and anything that isn't a letter or digit, and keep 20 characters
+# (Memoized, since the same artists and tracks come up over and over, especially during backfills)
+@lru_cache(maxsize=65536)
+def slug_part(text):
+    text = THE_PATTERN.sub('', text.lower())
+
+    # (After lowercasing, [^a-z0-9] removes the same characters as the original [^a-zA-Z0-9])
+    text = NON_ALNUM_PATTERN.sub('', text)
+    return text[:20]
+
+
+# Combine track and artist in lowercase to check for uniqueness among variations in database
+def convert_to_slug(track, artist):
+    return slug_part(track) + slug_part(artist)
+
+
+# Credits and version tags that don't change which song it is, e.g. "(feat. X)", "ft. X",
+# "(2011 Remaster)", "- Remastered 2004", "[Radio Edit]", "(Single Version)"
+FEATURING_PATTERN = re.compile(r'[\(\[]\s*(?:feat|ft|featuring)\b[^\)\]]*[\)\]]|\s(?:feat|ft|featuring)\b\.?\s.*$')
+VERSION_PATTERN = re.compile(
+    r'[\(\[][^\)\]]*\b(?:remaster|remastered|radio edit|single version|album version|mono|stereo|explicit|clean)\b[^\)\]]*[\)\]]'
+    r'|\s-\s[^-]*\b(?:remaster|remastered|radio edit|single version|album version|mono|stereo|explicit|clean)\b.*$'
+)
+NON_ALNUM_RUN_PATTERN = re.compile(r'[^a-z0-9]+')
+
+
+# Loose form of a title or artist for near-duplicate matching: lowercase, without featured
+# artists, remaster/edit tags, the word "the" or punctuation, with single spaces between words
+@lru_cache(maxsize=65536)
+def similarity_part(text):
+    text = text.lower()
+    text = FEATURING_PATTERN.sub('', text)
+    text = VERSION_PATTERN.sub('', text)
+    text = THE_PATTERN.sub('', text)
+    return NON_ALNUM_RUN_PATTERN.sub(' ', text).strip()
+
+
+
+# Key shared by near duplicates of a song, stored (and indexed) as songs.similarityKey: the
+# similarity_part of the title and of the artist.  So variants that convert_to_slug keeps apart
+# still match, e.g. "Stay (feat. Justin Bieber)" and "Stay", while anything that might be a
+# different recording (a remix, another part or movement, a different track number) never does.
+# Songs without a title get None and are never matched.
+def similarity_key(track, artist):
+    title = similarity_part(track or '')
+    return '{}|{}'.format(title, similarity_part(artist or '')) if title else None
@@ -0,0 +1,107 @@
+import queue
+import threading
+import time
+from metrics import metrics
+
+
+# Marks the end of a stage's input
+STOP = object()
+
+
+class Pipeline:
+    """Passes items through a series of stages, each with its own pool of worker threads.
+
+    `stages` is a list of (name, func, workers) tuples.  Each stage reads from a
+    bounded queue and feeds the next one, so a slow stage holds back the stages
+    in front of it instead of letting work pile up in memory, while every stage
+    still runs alongside the others (e.g. downloads overlap with transcoding).
+
+    A stage's func takes an item and returns True to hand it on to the next stage,
+    or False to drop it (the func records why on the item).  An exception raised by
+    a func is passed to `on_error(item, exception)` and drops the item.  Every item
+    leaves through `on_done(item)`, whether it finished the last stage or was dropped.
+
+    Each stage's run time and the time items spend queued in front of it are
+    recorded in the pipeline_stage_seconds and pipeline_queue_wait_seconds
+    histograms, and how items leave each stage in pipeline_items_total (passed,
+    dropped or error).  A stage with long queue waits is the bottleneck.
+    """
+
+    def __init__(self, stages, on_done, on_error=None, queue_size=4):
+        self.stages = stages
+        self.on_done = on_done
+        self.on_error = on_error
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.threads = []
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.running = [workers for name, func, workers in stages]
+
+    def start(self):
+        for i, (name, func, workers) in enumerate(self.stages):
+            for n in range(workers):
+                thread = threading.Thread(target=self.work, args=(i,), name='{}-{}'.format(name, n + 1))
+                thread.start()
+                self.threads.append(thread)
+        return self
+
+    # Add an item to the first stage, waiting while that stage's queue is full
+    def submit(self, item):
+        with self.condition:
+            self.in_flight += 1
+        self.queues[0].put((item, time.monotonic()))
+
+    # Wait until an item leaves the pipeline (or the timeout passes)
+    def wait(self, timeout=None):
+        with self.condition:
+            in_flight = self.in_flight
+            self.condition.wait_for(lambda: self.in_flight < in_flight, timeout=timeout)
+
+    # Let every submitted item finish, then stop the workers
+    def close(self):
+        for _ in range(self.stages[0][2]):
+            self.queues[0].put(STOP)
+        for thread in self.threads:
+            thread.join()
+
+    def work(self, i):
+        name, func, workers = self.stages[i]
+        while True:
+            entry = self.queues[i].get()
+            if entry is STOP:
+                break
+            item, queued = entry
+
+            start = time.monotonic()
+            metrics.observe('pipeline_queue_wait_seconds', start - queued, stage=name)
+            try:
+                passed = func(item)
+                result = 'passed' if passed else 'dropped'
+            except Exception as e:
+                passed = False
+                result = 'error'
+                if self.on_error:
+                    self.on_error(item, e)
+            metrics.observe('pipeline_stage_seconds', time.monotonic() - start, stage=name)
+            metrics.increment('pipeline_items_total', stage=name, result=result)
+
+            if passed and i + 1 < len(self.stages):
+                self.queues[i + 1].put((item, time.monotonic()))
+            else:
+                self.finish(item)
+
+        # (The last worker of a stage to stop tells the next stage's workers to stop)
+        with self.condition:
+            self.running[i] -= 1
+            last = self.running[i] == 0
+        if last and i + 1 < len(self.stages):
+            for _ in range(self.stages[i + 1][2]):
+                self.queues[i + 1].put(STOP)
+
+    def finish(self, item):
+        try:
+            self.on_done(item)
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
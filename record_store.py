@@ -0,0 +1,129 @@
+import json
+import os
+import random
+import sqlite3
+import threading
+
+
+# Records with one of these outcomes are never selected again
+FINAL_OUTCOMES = ('error', 'success')
+
+
+class RecordStore:
+    """music_scraper's song records, kept in SQLite with one row per record.
+
+    Behaves like the list loaded from songRecords.json: `store[i]` reads record i
+    and `store[i] = song` writes it back, so a run only reads and writes the
+    records it actually touches instead of loading and rewriting the whole
+    catalog.  Each record's outcome and stationName are also kept in their own
+    columns.  Each thread gets its own connection.
+
+    Records that may still be downloaded (no final outcome, and not from one of
+    `excluded_stations`) are flagged eligible whenever they are written, and each
+    record has a random key.  `sample` reads the partial index over eligible
+    records from a random key onwards, so choosing songs costs about as much as
+    the number of songs chosen rather than the size of the catalog.  Changing the
+    excluded stations re-flags every record once, the next time the store opens.
+    """
+
+    def __init__(self, path, excluded_stations=()):
+        self.path = path
+        self.excluded_stations = tuple(sorted(excluded_stations))
+        self.local = threading.local()
+
+        with self.connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS records '
+                '(idx INTEGER PRIMARY KEY, outcome TEXT, stationName TEXT, data TEXT NOT NULL, '
+                'eligible INTEGER NOT NULL DEFAULT 0, randomKey REAL)'
+            )
+            connection.execute('CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)')
+
+            # (Stores created before the eligibility index need its columns added and filled in)
+            columns = [row[1] for row in connection.execute('PRAGMA table_info(records)')]
+            if 'eligible' not in columns:
+                connection.execute('ALTER TABLE records ADD COLUMN eligible INTEGER NOT NULL DEFAULT 0')
+                connection.execute('ALTER TABLE records ADD COLUMN randomKey REAL')
+                connection.execute('DROP INDEX IF EXISTS ix_records_outcome')
+                connection.execute('DELETE FROM settings WHERE name = ?', ('excluded_stations',))
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_records_eligible ON records (randomKey) WHERE eligible = 1')
+
+            row = connection.execute('SELECT value FROM settings WHERE name = ?', ('excluded_stations',)).fetchone()
+            if row is None or json.loads(row[0]) != list(self.excluded_stations):
+                self.rebuild_eligibility(connection)
+
+    # Open the store at `path`, creating it from the JSON record list the first time
+    @classmethod
+    def open(cls, path, json_path, excluded_stations=()):
+        exists = os.path.exists(path)
+        store = cls(path, excluded_stations)
+        if not exists:
+            with open(json_path) as json_file:
+                store.extend(json.load(json_file))
+        return store
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.create_function('eligible', 2, self.is_eligible)
+            connection.create_function('random_key', 0, random.random)
+            self.local.connection = connection
+        return connection
+
+    def is_eligible(self, outcome, stationName):
+        return outcome not in FINAL_OUTCOMES and stationName not in self.excluded_stations
+
+    # Re-flag every record against the current excluded stations
+    def rebuild_eligibility(self, connection):
+        connection.execute(
+            'UPDATE records SET eligible = eligible(outcome, stationName), randomKey = COALESCE(randomKey, random_key())'
+        )
+        connection.execute('INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)',
+                           ('excluded_stations', json.dumps(list(self.excluded_stations))))
+
+    def extend(self, songs):
+        start = len(self)
+        with self.connection() as connection:
+            connection.executemany(
+                'INSERT INTO records (idx, outcome, stationName, data, eligible, randomKey) '
+                'VALUES (?, ?, ?, ?, eligible(?, ?), random_key())',
+                ((start + i, song.get('outcome', None), song.get('stationName', None), json.dumps(song),
+                  song.get('outcome', None), song.get('stationName', None))
+                 for i, song in enumerate(songs)),
+            )
+
+    # Indices of up to `count` randomly chosen eligible records
+    def sample(self, count):
+        start = random.random()
+        connection = self.connection()
+        indices = [row[0] for row in connection.execute(
+            'SELECT idx FROM records WHERE eligible = 1 AND randomKey >= ? ORDER BY randomKey LIMIT ?',
+            (start, count))]
+        if len(indices) < count:
+            indices += [row[0] for row in connection.execute(
+                'SELECT idx FROM records WHERE eligible = 1 AND randomKey < ? ORDER BY randomKey LIMIT ?',
+                (start, count - len(indices)))]
+        return indices
+
+    def __len__(self):
+        row = self.connection().execute('SELECT MAX(idx) FROM records').fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def __getitem__(self, index):
+        row = self.connection().execute('SELECT data FROM records WHERE idx = ?', (index,)).fetchone()
+        if row is None:
+            raise IndexError(index)
+        return json.loads(row[0])
+
+    def __setitem__(self, index, song):
+        outcome = song.get('outcome', None)
+        stationName = song.get('stationName', None)
+        with self.connection() as connection:
+            updated = connection.execute(
+                'UPDATE records SET outcome = ?, stationName = ?, data = ?, eligible = eligible(?, ?) WHERE idx = ?',
+                (outcome, stationName, json.dumps(song), outcome, stationName, index),
+            ).rowcount
+        if not updated:
+            raise IndexError(index)
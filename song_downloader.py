@@ -5,19 +5,26 @@
 
 
 import configparser
+import hashlib
 import json
 import logging
 import os
 import random
 import re
-import requests
 import threading
 import time
 import urllib.parse
 from datetime import date, datetime
+from audio_store import AudioStore
+from cache import MISSING, SQLiteCache, url_ttl
+from http_client import client, download_file
+from metrics import metrics
 from mutagen.easyid3 import EasyID3
-from pydub import AudioSegment
-from sqlalchemy.sql.expression import func
+from normalization import convert_to_slug, similarity_key
+from pipeline import Pipeline
+from transcoder import Transcoder
+from youtube_search import closest_video, search_videos
+from sqlalchemy import select, update
 
 
 # In[ ]:
@@ -40,10 +47,9 @@ dbURL = str(config['credentials']['dburl'])
 from sqlalchemy import create_engine
 engine = create_engine(dbURL)
 
-from sqlalchemy.orm import sessionmaker
-Session = sessionmaker(bind=engine)
-
-session = Session()
+# (Each thread gets its own session from the engine's connection pool)
+from sqlalchemy.orm import scoped_session, sessionmaker
+Session = scoped_session(sessionmaker(bind=engine, expire_on_commit=False))
 
 
 # In[ ]:
@@ -54,14 +60,25 @@ session = Session()
 from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base()
 
-from sqlalchemy import Column, Integer, String, Boolean
+from sqlalchemy import Column, Integer, String, Boolean, Float, Index, text
 class Song(Base):
     __tablename__ = 'songs'
+    __table_args__ = (
+        # (Partial index over songs still waiting to be downloaded, ordered by a random key,
+        # so song_downloader can sample pending songs without sorting the table)
+        Index('ix_songs_pending_random', 'station', 'randomKey',
+              postgresql_where=text('downloaded = false AND status IS NULL'),
+              sqlite_where=text('downloaded = 0 AND status IS NULL')),
+        # (Lets song_downloader find claims whose lease has expired)
+        Index('ix_songs_claimed', 'claimedAt',
+              postgresql_where=text("status = 'processing'"),
+              sqlite_where=text("status = 'processing'")),
+    )
     
     id = Column(Integer, primary_key=True)
     track = Column(String)
     artist = Column(String)
-    slug = Column(String)
+    slug = Column(String, unique=True, index=True)
     collection = Column(String)
     duration = Column(Integer)
     station = Column(String)
@@ -73,6 +90,9 @@ class Song(Base):
     videoURL = Column(String)
     outcome = Column(String)
     status = Column(String)
+    randomKey = Column(Float, default=random.random)
+    claimedAt = Column(Integer)
+    similarityKey = Column(String, index=True)
     
     def __repr__(self):
         return "<Song(track='%s', artist='%s', station='%s')" % (self.track, self.artist, self.station)
@@ -84,8 +104,47 @@ class Song(Base):
 # Configure global variables
 
 SUCCESSFUL_SONGS = 0
+FINISHED_SONGS = []
 SONG_COUNT_TO_DOWNLOAD = 50
-THREADS = []
+STATIONS = ['KBPA', 'W249AR', 'WQNQHD2', 'KUTX']
+
+# Number of pending songs claimed from a station at a time
+CLAIM_BATCH_SIZE = 10
+
+# Seconds a claimed song stays reserved for the process that claimed it, and seconds
+# between renewals of the claims this process still holds
+LEASE_SECONDS = 60 * 60
+RENEW_SECONDS = LEASE_SECONDS // 4
+
+# Songs this process has claimed and not saved yet, by ID
+# (Each song's `lease` is the claimedAt value it was claimed or last renewed with)
+HELD_SONGS = {}
+
+# Number of finished songs saved per commit
+COMMIT_BATCH_SIZE = 5
+
+# Worker threads for each stage of the download pipeline
+# (The transcode stage gets one thread per concurrent ffmpeg job)
+SEARCH_WORKERS = 2
+RESOLVE_WORKERS = 2
+DOWNLOAD_WORKERS = 3
+
+# Number of YouTube search results compared against the song's duration
+SEARCH_CANDIDATES = 3
+
+# Seconds a YouTube search result is reused for
+SEARCH_CACHE_TTL = 30 * 24 * 60 * 60
+searchCache = SQLiteCache('youtube_search', ttl=SEARCH_CACHE_TTL)
+
+# Seconds a resolved stream URL is reused for when it doesn't say when it expires,
+# and seconds to wait before asking the API again about a video it failed on
+STREAM_CACHE_TTL = 60 * 60
+STREAM_FAILURE_TTL = 15 * 60
+streamCache = SQLiteCache('stream_urls', ttl=STREAM_CACHE_TTL)
+
+# Song IDs downloaded during this run, by similarity key
+# (Their outcomes may not be saved yet, so the database doesn't know they're downloaded)
+DOWNLOADED_KEYS = {}
 
 
 # In[ ]:
@@ -110,12 +169,23 @@ def getQuery(song):
 
 
 # Attach video URL to song object
+# (A video found on an earlier attempt is reused, and searches are cached by slug, so a
+# retried song or the same track heard on another station doesn't search YouTube again)
 
 def getVideoURL(song):
-    response = requests.get('https://www.youtube.com/results?search_query={}'.format(song.query))
-    pattern = re.compile('"videoRenderer":{"videoId":"(.*?)"')
-    m = re.search(pattern, response.text)
-    videoURL = m.group(1)
+    if song.videoURL:
+        return song
+
+    key = convert_to_slug(song.track or '', song.artist or '')
+    videoURL = searchCache.get(key)
+    if videoURL is MISSING:
+        # (Of the top few results, take the one whose length best matches the song's)
+        results = search_videos(song.query, limit=SEARCH_CANDIDATES, durations=bool(song.duration))
+        if not results:
+            raise ValueError("No videos found for query {}".format(song.query))
+        videoURL = closest_video(results, song.duration)
+        searchCache.set(key, videoURL)
+
     song.videoURL = videoURL
     return song
 
@@ -123,7 +193,19 @@ def getVideoURL(song):
 # In[ ]:
 
 
+# Resolved stream URLs are cached until they expire, and API failures for a short while,
+# so a song retried after a failed download or dub doesn't spend another API call
+
 def getDownloadURL(song):
+    downloadURL = streamCache.get(song.videoURL)
+    if downloadURL is not MISSING:
+        if downloadURL:
+            song.downloadURL = downloadURL
+        else:
+            debug.warning("getDownloadURL skipped for song with ID {}; the API failed for this video recently.".format(song.id))
+            song.status = "api_error"
+        return song
+
     youtubeURL = 'https://www.youtube.com/watch?v={}'.format(song.videoURL)
     youtubeURL = urllib.parse.quote_plus(youtubeURL)
     apiURL = 'https://getvideo.p.rapidapi.com/?url={}'.format(youtubeURL)
@@ -131,16 +213,18 @@ def getDownloadURL(song):
         "X-RapidAPI-Host": apiHost,
         "X-RapidAPI-Key": apiKey
     }
-    response = requests.get(apiURL, headers=apiHeaders)
+    response = client.get(apiURL, headers=apiHeaders)
     response = json.loads(response.text)
     
     # There are several streams in the response; just grab the first one
     # (API has not been working recently; use try/except...)
     try:
         song.downloadURL = response['streams'][0]['url']
+        streamCache.set(song.videoURL, song.downloadURL, ttl=url_ttl(song.downloadURL, STREAM_CACHE_TTL))
     except Exception as e:
         debug.warning("getDownloadURL failed for song with ID {}.  Exception: {}".format(song.id, e))
         song.status = "api_error"
+        streamCache.set(song.videoURL, None, ttl=STREAM_FAILURE_TTL)
     finally:
         return song
 
@@ -156,25 +240,42 @@ def downloadSong(song):
     dateString = datetime.date(datetime.now()).strftime('%Y-%m-%d')
     directory = os.path.join(os.getcwd(), 'downloads', 'archive', dateString)
     filePath = os.path.join(directory, fileName)
-    with os_lock:
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-
-    r = requests.get(song.downloadURL, allow_redirects=True)
-    with open(filePath, 'wb') as file:
-        file.write(r.content)
-
-    # Set audio file metadata
-    with dub_lock:
-        time.sleep(0.2)
-        try:
-            dub_audio = AudioSegment.from_file(filePath, "m4a")
-            newFileName = re.sub(r'm4a$', r'mp3', fileName)
-            dub_audio.export(os.path.join(directory, newFileName), "mp3")
+    os.makedirs(directory, exist_ok=True)
+
+    hasher = hashlib.sha256()
+    try:
+        download_file(song.downloadURL, filePath, hasher=hasher)
+    except Exception:
+        # (The stream URL may have gone stale; resolve it again next time)
+        streamCache.delete(song.videoURL)
+        raise
+
+    song.filePath = filePath
+    song.digest = hasher.hexdigest()
+    return song
+
+
+# In[ ]:
+
+
+# Convert the downloaded m4a to mp3 and set audio file metadata
+# (If an identical download was already converted, its mp3 is copied instead)
+
+def transcodeSong(song):
+    filePath = song.filePath
+    try:
+        newFilePath = re.sub(r'm4a$', r'mp3', filePath)
+
+        # (The mp3 is tagged before other downloads with the same content may copy it)
+        with audioStore.lock_for(song.digest):
+            if audioStore.transcode(filePath, newFilePath, song.digest):
+                debug.info("Reused an existing mp3 for song with ID {}.".format(song.id))
             song.downloaded = True
 
             # (Specify default value of '' because value of None is not accepted)
-            audio = EasyID3(os.path.join(directory, newFileName))
+            # (A reused mp3 still has the tags of the song it was made for, so those are cleared first)
+            audio = EasyID3(newFilePath)
+            audio.clear()
             audio["title"] = song.track if song.track else ''
             audio["artist"] = song.artist if song.artist else ''
             audio["album"] = song.collection if song.collection else ''
@@ -182,91 +283,323 @@ def downloadSong(song):
             audio["genre"] = ";".join([song.station, 'Scraped']) if song.station else "Scraped"
             audio.save()
 
-            song.status = "success"
-            return song
+        song.status = "success"
+        return song
 
-        except Exception as e:
-            debug.error("Failed to convert song from m4a to mp3 for song with ID {}.  Exception: {}".format(song.id, e))
-            song.status = "dub_error"
-            return song
+    except Exception as e:
+        debug.error("Failed to convert song from m4a to mp3 for song with ID {}.  Exception: {}".format(song.id, e))
+        song.status = "dub_error"
+        return song
 
-        finally:
-            with os_lock:
-                os.remove(filePath)
-                time.sleep(0.2)
+    finally:
+        os.remove(filePath)
 
 
 # In[ ]:
 
 
-def getSong():
+# Mark up to `count` pending songs from one station as claimed, returning their IDs
+# (PostgreSQL and SQLite 3.35+ claim in one UPDATE ... RETURNING.  MySQL can't return rows
+# from an UPDATE or limit a subquery on the table being updated, so there the rows are
+# selected and locked first, then claimed by ID in the same transaction.)
+def claimPendingSongs(session, station, count, keyRange):
+    dialect = session.get_bind().dialect
+    candidates = (
+        select(Song.id)
+        .where(Song.downloaded == False, Song.status == None, Song.station == station, keyRange)
+        .order_by(Song.randomKey)
+        .limit(count)
+        .with_for_update(skip_locked=True)
+    )
+    claim = (
+        update(Song)
+        .values(status='processing', claimedAt=int(time.time()))
+        .execution_options(synchronize_session=False)
+    )
+
+    if dialect.name == 'postgresql' or (dialect.name == 'sqlite' and dialect.server_version_info >= (3, 35)):
+        return [songID for (songID,) in session.execute(claim.where(Song.id.in_(candidates)).returning(Song.id))]
+    if dialect.name == 'mysql':
+        songIDs = [songID for (songID,) in session.execute(candidates)]
+        if songIDs:
+            session.execute(claim.where(Song.id.in_(songIDs)))
+        return songIDs
+    raise NotImplementedError("No atomic claim statement for database dialect {} {}".format(
+        dialect.name, '.'.join(map(str, dialect.server_version_info or ()))))
+
+
+# Claim a batch of random pending songs from one station
+# (Reads the pending songs' index in randomKey order from a random starting point, wrapping
+# around at the end, so selection doesn't sort the table and stays fast as it grows.
+# Claimed rows are marked 'processing' with a lease timestamp and committed straight away;
+# rows locked by another downloader are skipped, so parallel processes on any host never
+# claim the same song.)
+
+def claimSongs(station, count=CLAIM_BATCH_SIZE):
+    session = Session()
+    start = random.random()
+    claimedIDs = []
+
+    try:
+        for keyRange in [Song.randomKey >= start, Song.randomKey < start]:
+            if len(claimedIDs) >= count:
+                break
+            claimedIDs += claimPendingSongs(session, station, count - len(claimedIDs), keyRange)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    if not claimedIDs:
+        return []
+
+    # (Claimed songs are detached from the session, since pipeline threads update them
+    # while the session is in use; their outcomes are written back by saveOutcomes)
+    songs = session.query(Song).filter(Song.id.in_(claimedIDs)).all()
+    for song in songs:
+        session.expunge(song)
+        song.lease = song.claimedAt
+        HELD_SONGS[song.id] = song
+    return songs
+
+
+# Extend the lease on every song this process still holds, so other downloaders don't
+# release them as expired during a long run.  Songs whose claim has been taken away
+# (e.g. this process stalled for longer than the lease) are dropped and marked claimLost.
+
+def renewClaims():
+    session = Session()
+    now = int(time.time())
+    renewed, lost = [], []
+    for song in list(HELD_SONGS.values()):
+        renew = (
+            update(Song)
+            .where(Song.id == song.id, Song.status == 'processing', Song.claimedAt == song.lease)
+            .values(claimedAt=now)
+            .execution_options(synchronize_session=False)
+        )
+        (renewed if session.execute(renew).rowcount else lost).append(song)
+    session.commit()
+
+    for song in renewed:
+        song.lease = song.claimedAt = now
+    for song in lost:
+        song.claimLost = True
+        del HELD_SONGS[song.id]
+    if lost:
+        debug.warning("Lost the claim on songs with IDs {}.".format([song.id for song in lost]))
+
+
+# Release claims whose lease expired (e.g. their downloader crashed) so they can be claimed again
+
+def reclaimExpiredSongs():
+    session = Session()
+    expired = (
+        update(Song)
+        .where(Song.status == 'processing', Song.claimedAt < int(time.time()) - LEASE_SECONDS)
+        .values(status=None, claimedAt=None)
+        .execution_options(synchronize_session=False)
+    )
+    count = session.execute(expired).rowcount
+    session.commit()
+    if count:
+        debug.info("Released {} songs with expired claims.".format(count))
+
+
+# Write the outcomes of finished songs back to the database in one commit
+# (Only where this process still holds the claim, so a song another downloader has since
+# claimed is left to that downloader)
+
+def saveOutcomes(songs):
+    session = Session()
+    lost = []
+    for song in songs:
+        if getattr(song, 'claimLost', False):
+            continue
+        save = (
+            update(Song)
+            .where(Song.id == song.id, Song.claimedAt == song.lease)
+            .values(query=song.query, videoURL=song.videoURL, downloaded=song.downloaded,
+                    status=song.status, claimedAt=song.claimedAt)
+            .execution_options(synchronize_session=False)
+        )
+        if not session.execute(save).rowcount:
+            lost.append(song.id)
+    session.commit()
+
+    for song in songs:
+        HELD_SONGS.pop(song.id, None)
+    if lost:
+        debug.warning("Didn't save songs with IDs {}; their claims were taken by another downloader.".format(lost))
+
+
+# Release songs this run claimed but never got to
+
+def releaseUnusedClaims(candidates):
+    songs = []
+    for station in candidates:
+        for song in candidates[station]:
+            song.status = None
+            song.claimedAt = None
+            songs.append(song)
+        candidates[station] = []
+    saveOutcomes(songs)
+
+
+# ID of a downloaded song that only differs from `song` by a "feat." credit, remaster tag or
+# punctuation, or None if there is none
+# (Looked up on the indexed songs.similarityKey, so nothing is loaded up front)
+
+def findDuplicate(song):
+    key = similarity_key(song.track, song.artist)
+    if key is None:
+        return None
+    with lock:
+        duplicate = DOWNLOADED_KEYS.get(key)
+    if duplicate is not None and duplicate != song.id:
+        return duplicate
+
+    session = Session()
+    duplicate = session.query(Song.id).filter(
+        Song.similarityKey == key, Song.downloaded == True, Song.id != song.id
+    ).limit(1).scalar()
+    session.commit()
+    return duplicate
+
+
+# In[ ]:
+
+
+def getSong(candidates):
     global SUCCESSFUL_SONGS
     
     # Select one random song from database
-    with db_lock:
-        
-        # Select a random station
-        station = random.choice(['KBPA', 'W249AR', 'WQNQHD2', 'KUTX'])
-        
-        song = session.query(Song).filter(Song.downloaded == False, Song.status == None, Song.station == station).order_by(func.random()).first()
-
-        # (If no song is found, cancel the process)
-        if not song:
-            debug.warning("No song found when looking in station {}.".format(station))
-            with lock:
-                SUCCESSFUL_SONGS += 1
-            return
+    # (Select a random station, then take the next song claimed from it)
+    station = random.choice(STATIONS)
+
+    # (Songs whose claim was lost while they waited are skipped)
+    candidates[station] = [song for song in candidates[station] if not getattr(song, 'claimLost', False)]
+    if not candidates[station]:
+        candidates[station] = claimSongs(station)
+    song = candidates[station].pop() if candidates[station] else None
+
+    # (If no song is found, cancel the process)
+    if not song:
+        debug.warning("No song found when looking in station {}.".format(station))
+        with lock:
+            SUCCESSFUL_SONGS += 1
+        return
+
+    # (A near duplicate of a downloaded song is saved as such without going through the pipeline)
+    duplicate = findDuplicate(song)
+    if duplicate is not None:
+        debug.info("Skipping song with ID {} (near duplicate of song with ID {}).".format(song.id, duplicate))
+        song.status = "duplicate"
+        song.claimedAt = None
+        metrics.increment('songs_total', status=song.status, station=song.station)
+        with lock:
+            FINISHED_SONGS.append(song)
+        return
 
-        song.status = 'processing'
+    return song
 
-    try:
-        getQuery(song)
-        getVideoURL(song)    
-        getDownloadURL(song)
-        
-        if getattr(song, 'downloadURL', None):
-            downloadSong(song)
-            if song.status == "success":
-                with lock:
-                    SUCCESSFUL_SONGS += 1   
 
-    except Exception as e:
-        debug.error("getSong failed somewhere for song with ID {}.  Exception: {}".format(song.id, e))
-        song.status = "uncaught_error"
+# In[ ]:
+
+
+# Pipeline stages; each returns whether the song should go on to the next stage
+
+def searchStage(song):
+    getQuery(song)
+    getVideoURL(song)
+    return True
+
+def resolveStage(song):
+    getDownloadURL(song)
+    return bool(getattr(song, 'downloadURL', None))
+
+# (Songs another downloader has claimed since aren't downloaded or transcoded twice)
+def downloadStage(song):
+    if getattr(song, 'claimLost', False):
+        return False
+    downloadSong(song)
+    return True
+
+def transcodeStage(song):
+    if getattr(song, 'claimLost', False):
+        os.remove(song.filePath)
+        return False
+    transcodeSong(song)
+    return True
 
 
 # In[ ]:
 
 
-def runThread():
+def songFailed(song, e):
+    debug.error("getSong failed somewhere for song with ID {}.  Exception: {}".format(song.id, e))
+    song.status = "uncaught_error"
+
+def songFinished(song):
     global SUCCESSFUL_SONGS
-    global SONG_COUNT_TO_DOWNLOAD
-    global THREADS
-    
-    THREADS.append(threading.current_thread().name)
-    
-    while (SUCCESSFUL_SONGS + len(THREADS)) <= SONG_COUNT_TO_DOWNLOAD:
-        getSong()
-        time.sleep(0.5)
-        
-    THREADS.remove(threading.current_thread().name)
+
+    metrics.increment('songs_total', status=song.status, station=song.station)
+
+    with lock:
+        if song.status == "success":
+            SUCCESSFUL_SONGS += 1
+            key = similarity_key(song.track, song.artist)
+            if key is not None:
+                DOWNLOADED_KEYS.setdefault(key, song.id)
+        FINISHED_SONGS.append(song)
 
 
 # In[ ]:
 
 
-def initializeThreads():
-    t1 = threading.Thread(target=runThread, name='t1')
-    t2 = threading.Thread(target=runThread, name='t2')
-    t3 = threading.Thread(target=runThread, name='t3')
+# Claim songs and feed them through the search, API, download and transcode stages,
+# keeping just enough songs in flight to reach SONG_COUNT_TO_DOWNLOAD successes.
+# Finished songs are saved every COMMIT_BATCH_SIZE songs, so a crash loses at most a few
+# (songs whose outcome wasn't saved are released again once their lease expires).
+# Claims still held are renewed every RENEW_SECONDS so a long run doesn't lose them.
 
-    t1.start()
-    t2.start()
-    t3.start()
+def runPipeline():
+    pipeline = Pipeline([
+        ('search', searchStage, SEARCH_WORKERS),
+        ('resolve', resolveStage, RESOLVE_WORKERS),
+        ('download', downloadStage, DOWNLOAD_WORKERS),
+        ('transcode', transcodeStage, transcoder.workers),
+    ], on_done=songFinished, on_error=songFailed).start()
 
-    t1.join()
-    t2.join() 
-    t3.join()
+    candidates = {station: [] for station in STATIONS}
+    renewed = time.time()
+
+    try:
+        while True:
+            with lock:
+                remaining = SONG_COUNT_TO_DOWNLOAD - SUCCESSFUL_SONGS
+                finished = FINISHED_SONGS[:] if len(FINISHED_SONGS) >= COMMIT_BATCH_SIZE else []
+                del FINISHED_SONGS[:len(finished)]
+            if finished:
+                saveOutcomes(finished)
+            if time.time() - renewed >= RENEW_SECONDS:
+                renewClaims()
+                renewed = time.time()
+
+            if remaining <= 0:
+                break
+            if pipeline.in_flight >= remaining:
+                pipeline.wait(timeout=1)
+                continue
+
+            song = getSong(candidates)
+            if song:
+                pipeline.submit(song)
+
+    finally:
+        pipeline.close()
+        releaseUnusedClaims(candidates)
+        saveOutcomes(FINISHED_SONGS)
 
 
 # In[ ]:
@@ -284,16 +617,19 @@ if __name__ == '__main__':
     debug.addHandler(logging.StreamHandler())
 
     # Define locks for threading
-    db_lock = threading.Lock()
-    os_lock = threading.Lock()
-    dub_lock = threading.Lock()
     lock = threading.Lock()
 
-    # Initialize threads
-    initializeThreads()
-    
-    # Save the results in the database
-    session.commit()
+    # Set up the transcoder
+    transcoder = Transcoder.from_config(config)
+    audioStore = AudioStore(transcoder)
+
+    # Run the download pipeline
+    reclaimExpiredSongs()
+    runPipeline()
+
+    # Save the run's stage timings and counters
+    metrics.write('song_downloader_metrics.json')
+    metrics.write('song_downloader_metrics.prom')
 
     debug.info("Finished run") 
 
@@ -301,5 +637,5 @@ if __name__ == '__main__':
 # In[ ]:
 
 
-session.close()
+Session.remove()
 
@@ -0,0 +1,212 @@
+import aiohttp
+import asyncio
+import hashlib
+import json
+import logging
+from datetime import datetime
+from http_client import RETRY_STATUSES, backoff_delay, retry_after
+from lxml import etree
+from normalization import convert_duration
+
+
+# Adapter classes keyed by name; entries in URLs.json are matched to these by station name
+# (or by an explicit "adapter" key when a station shares another station's feed format)
+ADAPTERS = {}
+
+
+def register_adapter(name):
+    def decorator(cls):
+        ADAPTERS[name] = cls
+        return cls
+    return decorator
+
+
+def load_adapters(URLs):
+    adapters = []
+    for station, entry in URLs.items():
+        # (Entries are either a bare URL or an object with a "url" key and options)
+        if isinstance(entry, str):
+            entry = {'url': entry}
+        name = entry.get('adapter', station)
+
+        if name not in ADAPTERS:
+            logging.warning('{} - No adapter registered with name {}'.format(station, name))
+            continue
+
+        options = {key: value for key, value in entry.items() if key != 'adapter'}
+        adapters.append(ADAPTERS[name](station, **options))
+    return adapters
+
+
+### Helper functions
+
+# Converts date string to unix time
+def convert_date(datePlayed):
+    result = datetime.strptime(datePlayed, "%m-%d-%Y %H:%M:%S")
+
+    # Convert to timestamp with hacky workaround to compensate for time zone
+    result = int(result.timestamp() + 21600)
+
+    return result
+
+
+class StationAdapter:
+    """Fetches one station's recently-played feed and parses it into song records.
+
+    Subclasses implement `entries`, which splits the fetched payload into raw
+    playlist entries (in any order), and `parse_entry`, which turns one entry into a dict of
+    Song column values (track, artist, collection, duration, program, datePlayed).
+    Entries are parsed one at a time so a malformed track only drops that track.
+    Feeds are fetched through a shared aiohttp session, each with its own timeout;
+    connection errors, timeouts and 429/5xx responses are retried up to `retries`
+    times with jittered exponential backoff (or as long as Retry-After asks).
+    In daemon mode each station is polled every `interval` seconds, give or take
+    `jitter` seconds.
+
+    Feeds are fetched conditionally: the ETag and Last-Modified validators and a
+    hash of the last payload that was saved are kept on the adapter, and `fetch`
+    returns None when the server answers 304 or sends back the same payload.
+    `watermark` is the latest datePlayed already ingested; entries at or before
+    it are skipped.
+    """
+
+    def __init__(self, station, url, timeout=30, interval=1800, jitter=60, retries=3):
+        self.station = station
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.interval = interval
+        self.jitter = jitter
+
+        # Validators of the last saved payload, and of the last fetched one
+        self.etag = None
+        self.last_modified = None
+        self.payload_hash = None
+        self.validators = (None, None, None)
+        self.watermark = None
+
+    def __repr__(self):
+        return "<{}(station='{}')>".format(type(self).__name__, self.station)
+
+    async def fetch(self, client):
+        attempt = 0
+        while True:
+            try:
+                return await self.fetch_once(client)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status = getattr(e, 'status', None)
+                if attempt >= self.retries or (status is not None and status not in RETRY_STATUSES):
+                    raise
+                delay = retry_after(getattr(e, 'headers', None))
+                await asyncio.sleep(delay if delay is not None else backoff_delay(attempt))
+                attempt += 1
+
+    async def fetch_once(self, client):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with client.get(self.url, headers=headers, timeout=timeout) as response:
+            if response.status == 304:
+                return None
+            response.raise_for_status()
+            content = await response.read()
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+
+        payload_hash = hashlib.sha256(content).hexdigest()
+        self.validators = (etag, last_modified, payload_hash)
+
+        # (Some feeds send no validators at all; skip the payload if it is byte-identical)
+        if payload_hash == self.payload_hash:
+            self.etag, self.last_modified = etag, last_modified
+            return None
+        return content
+
+    def entries(self, content):
+        raise NotImplementedError
+
+    def parse_entry(self, entry):
+        raise NotImplementedError
+
+
+@register_adapter('KBPA')
+class KBPAAdapter(StationAdapter):
+
+    def entries(self, content):
+        root = etree.fromstring(content)
+        return root.xpath('//nowplaying-info[@type="track"]')
+
+    def parse_entry(self, s):
+        return {
+            'track': s.xpath('.//property[@name="cue_title"]')[0].text,
+            'artist': s.xpath('.//property[@name="track_artist_name"]')[0].text,
+            'duration': convert_duration(s.xpath('.//property[@name="cue_time_duration"]')[0].text),
+            'program': s.xpath('.//property[@name="program_id"]')[0].text,
+            'datePlayed': s.attrib.get('timestamp'),
+        }
+
+
+@register_adapter('W249AR')
+class W249ARAdapter(StationAdapter):
+
+    def entries(self, content):
+        content = json.loads(content)
+        return content['data']['sites']['find']['stream']['amp']['recentlyPlayed']['tracks']
+
+    def parse_entry(self, s):
+        return {
+            'track': s['title'],
+            'artist': s['artist']['artistName'],
+            'collection': s['albumName'],
+            'duration': s['trackDuration'],
+            'datePlayed': s['startTime'],
+        }
+
+
+@register_adapter('WQNQHD2')
+class WQNQHD2Adapter(StationAdapter):
+
+    def entries(self, content):
+        content = json.loads(content)
+        return content['data']
+
+    def parse_entry(self, s):
+        return {
+            'track': s['title'],
+            'artist': s['artist'],
+            'collection': s['album'],
+            'duration': s['trackDuration'],
+            'datePlayed': s['startTime'],
+        }
+
+
+@register_adapter('KUTX')
+class KUTXAdapter(StationAdapter):
+
+    def entries(self, content):
+        content = json.loads(content)
+
+        # Find the most recently-played (currently-playing) program playlist
+        playlist = None
+        for program in content['onToday']:
+            if program.get('has_playlist', None):
+                if program['playlist']:
+                    playlist = program['playlist']
+                else:
+                    break
+
+        # Gather information for 20 most recent songs (playlist is oldest first)
+        return playlist[-20:][::-1]
+
+    def parse_entry(self, s):
+        return {
+            'track': s['trackName'],
+            'artist': s['artistName'],
+            'collection': s.get('collectionName', None),
+            'duration': s['_duration'] / 1000,
+            'datePlayed': convert_date(s['_start_time']),
+        }
@@ -35,7 +35,7 @@ with open('URLs.json', 'r') as file:
 # Connect to database
 
 from sqlalchemy import create_engine
-engine = create_engine(dbURL)
+engine = create_engine(dbURL, pool_pre_ping=True)
 
 from sqlalchemy.orm import sessionmaker
 Session = sessionmaker(bind=engine)
@@ -46,17 +46,29 @@ Session = sessionmaker(bind=engine)
 
 # Define database object mapping
 
+import random
 from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base()
 
-from sqlalchemy import Column, Integer, String, Boolean
+from sqlalchemy import Column, Integer, String, Boolean, Float, Index, text
 class Song(Base):
     __tablename__ = 'songs'
+    __table_args__ = (
+        # (Partial index over songs still waiting to be downloaded, ordered by a random key,
+        # so song_downloader can sample pending songs without sorting the table)
+        Index('ix_songs_pending_random', 'station', 'randomKey',
+              postgresql_where=text('downloaded = false AND status IS NULL'),
+              sqlite_where=text('downloaded = 0 AND status IS NULL')),
+        # (Lets song_downloader find claims whose lease has expired)
+        Index('ix_songs_claimed', 'claimedAt',
+              postgresql_where=text("status = 'processing'"),
+              sqlite_where=text("status = 'processing'")),
+    )
     
     id = Column(Integer, primary_key=True)
     track = Column(String)
     artist = Column(String)
-    slug = Column(String)
+    slug = Column(String, unique=True, index=True)
     collection = Column(String)
     duration = Column(Integer)
     station = Column(String)
@@ -68,241 +80,311 @@ class Song(Base):
     videoURL = Column(String)
     outcome = Column(String)
     status = Column(String)
+    randomKey = Column(Float, default=random.random)
+    claimedAt = Column(Integer)
+    similarityKey = Column(String, index=True)
     
     def __repr__(self):
         return "<Song(track='%s', artist='%s', station='%s')" % (self.track, self.artist, self.station)
 
+# Per-station polling state, so unchanged feeds can be skipped across runs
+class StationState(Base):
+    __tablename__ = 'station_states'
 
-# In[ ]:
-
+    station = Column(String, primary_key=True)
+    etag = Column(String)
+    lastModified = Column(String)
+    payloadHash = Column(String)
+    watermark = Column(Integer)
 
-# If running the script for the first time, create the table within the database:
-
-# Base.metadata.create_all(engine)
+    def __repr__(self):
+        return "<StationState(station='%s', watermark='%s')" % (self.station, self.watermark)
 
 
 # In[ ]:
 
 
-### Helper functions
-
-# Convert time string to int of seconds
-def convert_duration(duration):
-    pattern = re.compile('(\d+)')
-    groups = re.findall(pattern, duration)
-
-    # Check that the duration appears to be a parsable value
-    if (len(groups) not in [1,2,3]):
-        return None
-
-    seconds = 0
-    for i, x in enumerate(groups):
-        multiplier = 60 ** (len(groups) - 1 - i)
-        seconds += int(x) * multiplier
-    return seconds
+# If running the script for the first time, create the tables within the database:
+# (When upgrading, this also adds any tables that are new since the last version)
 
-# Combine track and artist in lowercase to check for uniqueness among variations in database
-def convert_to_slug(track, artist):
-    
-    track = track.lower()
-    track = re.sub(r'(?<!\w)the(?!\w)', '', track)
-    track = re.sub(r'[^a-zA-Z0-9]', '', track)
-    track = track[:20]
-    
-    artist = artist.lower()
-    artist = re.sub(r'(?<!\w)the(?!\w)', '', artist)
-    artist = re.sub(r'[^a-zA-Z0-9]', '', artist)
-    artist = artist[:20]
-    
-    slug = track + artist
-    return slug
-
-# Converts date string to unix time
-def convert_date(datePlayed):
-    result = datetime.strptime(datePlayed, "%m-%d-%Y %H:%M:%S")
-    
-    # Convert to timestamp with hacky workaround to compensate for time zone
-    result = int(result.timestamp() + 21600)
-    
-    return result
+# Base.metadata.create_all(engine)
 
 
 # In[ ]:
 
 
-### GRAB SONGS
-
-from lxml import etree
-import requests
-import json
-import re
-from datetime import datetime
-
-
-# In[ ]:
+# If upgrading an existing database, run whichever of these steps are newer than the database:
+# (Each step works on PostgreSQL, SQLite and MySQL, and runs inside the one transaction)
 
+from normalization import similarity_key
+from sqlalchemy import bindparam, select, update
 
-session = Session()
+# Add a model column to its existing table, quoting the name and type for the database
+def add_column(conn, column):
+    quote = conn.dialect.identifier_preparer.quote
+    conn.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+        quote(column.table.name), quote(column.name), column.type.compile(dialect=conn.dialect))))
 
+# Fill in a column where it is NULL, with value(*sources) computed in Python for each row
+def backfill(conn, column, value, sources=(), batch_size=10000):
+    table = column.table
+    lastID = 0
+    while True:
+        rows = conn.execute(
+            select(table.c.id, *sources).where(column == None, table.c.id > lastID).order_by(table.c.id).limit(batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        conn.execute(update(table).where(table.c.id == bindparam('rowID')).values({column.name: bindparam('value')}),
+                     [{'rowID': row[0], 'value': value(*row[1:])} for row in rows])
+        lastID = rows[-1][0]
 
-# In[ ]:
+# with engine.begin() as conn:
 
+    # (Keep the first row of each slug, before the unique index on slug is created)
+    # conn.execute(text('DELETE FROM songs WHERE id NOT IN (SELECT id FROM (SELECT MIN(id) AS id FROM songs GROUP BY slug) AS keep)'))
 
-### KBPA
+    # add_column(conn, StationState.__table__.c.watermark)
 
-page = requests.get(URLs['KBPA'])
-root = etree.fromstring(page.content)
+    # (Songs without a random key are never claimed, so existing rows need one)
+    # add_column(conn, Song.__table__.c.randomKey)
+    # backfill(conn, Song.__table__.c.randomKey, random.random)
 
-for s in root.xpath('//nowplaying-info[@type="track"]'):
-    try:
-        track = s.xpath('.//property[@name="cue_title"]')[0].text
-        artist = s.xpath('.//property[@name="track_artist_name"]')[0].text
-        slug = convert_to_slug(track, artist)
+    # add_column(conn, Song.__table__.c.claimedAt)
 
-        # (Check if song is already in database and should be skipped)
-        if session.query(Song).filter(Song.slug == slug).count():
-            continue
+    # add_column(conn, Song.__table__.c.similarityKey)
+    # backfill(conn, Song.__table__.c.similarityKey, similarity_key, [Song.__table__.c.track, Song.__table__.c.artist])
 
-        song = Song()
-        song.track = track
-        song.artist = artist
-        song.slug = slug
-        song.duration = convert_duration(s.xpath('.//property[@name="cue_time_duration"]')[0].text)
-        song.program = s.xpath('.//property[@name="program_id"]')[0].text
-        song.datePlayed = s.attrib.get('timestamp')
-        song.station = 'KBPA'
-
-        session.add(song)
-        
-    except Exception as e:
-        logging.error('{} - {}'.format('KBPA', e))
-    
-session.commit()
+# (Then add any indexes the database doesn't have yet)
+# for index in Song.__table__.indexes: index.create(engine, checkfirst=True)
 
 
 # In[ ]:
 
 
-### W249AR
-
-page = requests.get(URLs['W249AR'])
-content = json.loads(page.text)
+### Helper functions
 
-for s in content['data']['sites']['find']['stream']['amp']['recentlyPlayed']['tracks']:
+from metrics import metrics
+
+# Song columns filled in from a station feed
+SONG_FIELDS = ['track', 'artist', 'slug', 'similarityKey', 'collection', 'duration', 'station', 'program', 'datePlayed']
+
+# Slugs known to be in the database, kept warm between polls so known songs aren't sent again
+known_slugs = set()
+
+# Drop records whose slug is already saved (or appears earlier in the batch),
+# and records that are a near duplicate of a saved or earlier song under a different slug
+# (e.g. a "feat." credit or remaster tag the slug doesn't strip)
+# (Saved near duplicates are found with one query on the indexed songs.similarityKey)
+def filter_new_songs(session, records):
+    records = [record for record in records if record['slug'] not in known_slugs]
+    keys = {record['similarityKey'] for record in records if record['similarityKey'] is not None}
+    saved = session.query(Song.similarityKey, Song.slug).filter(Song.similarityKey.in_(keys)) if keys else []
+    duplicates = {}
+    slugs = set()
+    for key, slug in saved:
+        duplicates.setdefault(key, slug)
+        slugs.add(slug)
+
+    new_records = []
+    for record in records:
+        if record['slug'] in slugs:
+            continue
+        duplicate = duplicates.get(record['similarityKey'])
+        if duplicate is not None and duplicate != record['slug']:
+            logging.info('{} - Skipping {} (near duplicate of {})'.format(record['station'], record['slug'], duplicate))
+            metrics.increment('near_duplicates_total', station=record['station'])
+            continue
+        slugs.add(record['slug'])
+        if record['similarityKey'] is not None:
+            duplicates.setdefault(record['similarityKey'], record['slug'])
+        new_records.append(record)
+    return new_records
+
+# Insert statement that skips rows whose slug is already in the table
+# (Relies on the unique index on songs.slug, which also makes overlapping runs safe)
+def insert_new_songs(records):
+    dialect = engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(Song).values(records).on_conflict_do_nothing(index_elements=['slug'])
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        return insert(Song).values(records).on_conflict_do_nothing(index_elements=['slug'])
+    if dialect == 'mysql':
+        from sqlalchemy import insert
+        return insert(Song).values(records).prefix_with('IGNORE')
+    raise NotImplementedError("No insert-or-ignore statement for database dialect {}".format(dialect))
+
+# Give each adapter the feed validators saved by earlier runs
+def load_station_states(session, adapters):
+    states = {state.station: state for state in session.query(StationState)}
+    for adapter in adapters:
+        state = states.get(adapter.station)
+        if state:
+            adapter.etag = state.etag
+            adapter.last_modified = state.lastModified
+            adapter.payload_hash = state.payloadHash
+            adapter.watermark = state.watermark
+
+# Parse the new plays in one station's feed into Song records.
+# Also returns the latest datePlayed seen (the station's new watermark), so that
+# next time only plays newer than it are kept.
+def parse_station(adapter, content):
     try:
-        track = s['title']
-        artist = s['artist']['artistName']
-        slug = convert_to_slug(track, artist)
-
-        # (Check if song is already in database and should be skipped)
-        if session.query(Song).filter(Song.slug == slug).count():
-            continue    
-
-        song = Song()
-        song.track = track
-        song.artist = artist
-        song.slug = slug
-        song.collection = s['albumName']
-        song.duration = s['trackDuration']
-        song.datePlayed = s['startTime']
-        song.station = 'W249AR'
-
-        session.add(song)
-        
+        entries = adapter.entries(content)
     except Exception as e:
-        logging.error('{} - {}'.format('W249AR', e))    
-
-session.commit()
-
-
-# In[ ]:
-
-
-### WQNQHD2
-
-page = requests.get(URLs['WQNQHD2'])
-content = json.loads(page.text)
-
-for s in content['data']:
+        logging.error('{} - {}'.format(adapter.station, e))
+        return [], adapter.watermark
+
+    records = []
+    watermark = adapter.watermark
+    for s in entries:
+        try:
+            record = adapter.parse_entry(s)
+            datePlayed = int(record['datePlayed']) if record.get('datePlayed') is not None else None
+
+            # (Skipped rather than stopping here, since not every feed lists its newest plays first)
+            if datePlayed is not None and adapter.watermark is not None and datePlayed <= adapter.watermark:
+                continue
+            if datePlayed is not None:
+                watermark = max(watermark or 0, datePlayed)
+
+            record['slug'] = convert_to_slug(record['track'], record['artist'])
+            record['similarityKey'] = similarity_key(record['track'], record['artist'])
+            record['station'] = adapter.station
+            records.append({field: record.get(field) for field in SONG_FIELDS})
+
+        except Exception as e:
+            logging.error('{} - {}'.format(adapter.station, e))
+
+    return records, watermark
+
+# Save the parsed plays of one or more stations in a single insert and transaction,
+# along with each feed's validators and watermark so unchanged feeds are skipped next time
+def save_stations(session, results):
+    records = []
+    inserted = 0
     try:
-        track = s['title']
-        artist = s['artist']
-        slug = convert_to_slug(track, artist)
-
-        # (Check if song is already in database and should be skipped)
-        if session.query(Song).filter(Song.slug == slug).count():
-            continue    
-
-        song = Song()
-        song.track = track
-        song.artist = artist
-        song.slug = slug
-        song.collection = s['album']
-        song.duration = s['trackDuration']
-        song.datePlayed = s['startTime']
-        song.station = 'WQNQHD2'
-
-        session.add(song)
-        
+        records = filter_new_songs(session, [record for adapter, station_records, watermark in results for record in station_records])
+        if records:
+            # (Songs already in the table are skipped by the insert and not counted in its rowcount)
+            inserted = session.execute(insert_new_songs(records)).rowcount
+        for adapter, station_records, watermark in results:
+            etag, last_modified, payload_hash = adapter.validators
+            session.merge(StationState(station=adapter.station, etag=etag, lastModified=last_modified,
+                                       payloadHash=payload_hash, watermark=watermark))
+        session.commit()
     except Exception as e:
-        logging.error('{} - {}'.format('WQNQHD2', e))        
-
-session.commit()
+        session.rollback()
+        stations = ', '.join(adapter.station for adapter, station_records, watermark in results)
+        logging.error('{} - Failed to save songs: {}'.format(stations, e))
+        return
+
+    for record in records:
+        known_slugs.add(record['slug'])
+        metrics.increment('songs_submitted_total', station=record['station'])
+    metrics.increment('songs_saved_total', max(inserted, 0))
+    for adapter, station_records, watermark in results:
+        adapter.etag, adapter.last_modified, adapter.payload_hash = adapter.validators
+        adapter.watermark = watermark
+
+# Fetch one station's feed, returning the error instead of raising so other stations carry on
+async def fetch_station(client, semaphore, adapter):
+    async with semaphore:
+        try:
+            with metrics.timer('station_fetch_seconds', station=adapter.station):
+                content = await adapter.fetch(client)
+        except Exception as e:
+            metrics.increment('station_fetches_total', station=adapter.station, result='error')
+            return adapter, None, e
+    metrics.increment('station_fetches_total', station=adapter.station, result='unchanged' if content is None else 'changed')
+    return adapter, content, None
+
+# HTTP client whose connection pool is shared by every station
+def create_client():
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_FETCHES)
+    return aiohttp.ClientSession(connector=connector)
+
+# Fetch every station at once, parsing each feed as soon as its response arrives,
+# then save the whole poll in one transaction
+async def poll_stations(session, adapters):
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+    results = []
+    async with create_client() as client:
+        fetches = [fetch_station(client, semaphore, adapter) for adapter in adapters]
+        for fetch in asyncio.as_completed(fetches):
+            adapter, content, error = await fetch
+            if error is not None:
+                logging.error('{} - Fetch failed: {!r}'.format(adapter.station, error))
+                continue
+            if content is not None:
+                records, watermark = parse_station(adapter, content)
+                results.append((adapter, records, watermark))
+    if results:
+        save_stations(session, results)
+
+# Poll one station forever, waiting its own interval (plus jitter) between polls
+async def run_station(session, client, semaphore, adapter):
+    # (Stagger the first polls so stations don't all fire at once)
+    await asyncio.sleep(random.uniform(0, adapter.jitter))
+    while True:
+        adapter, content, error = await fetch_station(client, semaphore, adapter)
+        if error is not None:
+            logging.error('{} - Fetch failed: {!r}'.format(adapter.station, error))
+        elif content is not None:
+            records, watermark = parse_station(adapter, content)
+            save_stations(session, [(adapter, records, watermark)])
+        await asyncio.sleep(max(adapter.interval + random.uniform(-adapter.jitter, adapter.jitter), 0))
+
+# Keep one engine, database session and HTTP pool alive while polling every station on its own schedule
+async def run_daemon(session, adapters):
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+    async with create_client() as client:
+        await asyncio.gather(*(run_station(session, client, semaphore, adapter) for adapter in adapters))
 
 
 # In[ ]:
 
 
-### KUTX
-
-page = requests.get(URLs['KUTX'])
-content = json.loads(page.text)
-
-# Find the most recently-played (currently-playing) program playlist
-playlist = None
-for program in content['onToday']:
-    if program.get('has_playlist', None):
-        if program['playlist']:
-            playlist = program['playlist']
-        else:
-            break
-
-# Gather information for 20 most recent songs
-for s in playlist[-20:]:
-    try:
-        track = s['trackName']
-        artist = s['artistName']
-        slug = convert_to_slug(track, artist)
+### GRAB SONGS
 
-        # (Check if song is already in database and should be skipped)
-        if session.query(Song).filter(Song.slug == slug).count():
-            continue
+import aiohttp
+import argparse
+import asyncio
+from normalization import convert_to_slug, similarity_key
+from station_adapters import load_adapters
 
-        song = Song()
-        song.track = track
-        song.artist = artist
-        song.slug = slug
-        song.collection = s.get('collectionName', None)
-        song.duration = s['_duration'] / 1000
-        song.datePlayed = convert_date(s['_start_time'])
-        song.station = 'KUTX'
-
-        session.add(song)
-        
-    except Exception as e:
-        logging.error('{} - {}'.format('KUTX', e))        
+# Upper bound on feeds being fetched at the same time
+MAX_CONCURRENT_FETCHES = 20
 
-session.commit()    
+adapters = load_adapters(URLs)
 
 
 # In[ ]:
 
 
-logging.info("Finished run")
-
-
-# In[ ]:
+if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description="Save recently-played songs from each station in URLs.json.")
+    parser.add_argument('--daemon', action='store_true',
+                        help="keep running and poll each station on its own interval instead of polling once")
+    parser.add_argument('--metrics-port', type=int,
+                        help="with --daemon, serve Prometheus metrics at http://localhost:PORT/metrics")
+    args = parser.parse_args()
 
-session.close()
-
+    session = Session()
+    load_station_states(session, adapters)
+    try:
+        if args.daemon:
+            if args.metrics_port:
+                metrics.serve(args.metrics_port)
+            logging.info("Starting daemon for {} stations".format(len(adapters)))
+            asyncio.run(run_daemon(session, adapters))
+        else:
+            asyncio.run(poll_stations(session, adapters))
+            logging.info("Finished run")
+    finally:
+        session.close()
+        metrics.write('station_api_scraper_metrics.json')
+        metrics.write('station_api_scraper_metrics.prom')
@@ -1,9 +1,24 @@
+import http.server
+import time
 import unittest
+from audio_store import AudioStore
+from http_client import HTTPSession, RateLimiter, download_file
+from metrics import Metrics
 from music_scraper import *
+from normalization import convert_duration, convert_to_slug, similarity_key
+from pipeline import Pipeline
+from record_store import RecordStore
 
 lock = threading.Lock()
 os_lock = threading.Lock()
 
+# Serve requests with `handler` (a BaseHTTPRequestHandler subclass) on a local port, returning the server and its URL
+def serve(handler):
+    handler.log_message = lambda self, format, *args: None
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}/'.format(server.server_port)
+
 def test_threads_exec(i):
     with lock:
         time.sleep(0.5)
@@ -53,15 +68,657 @@ class TestScraper(unittest.TestCase):
         self.downloadURL = getDownloadURL(song)
 
     def testdownloader(self):
-        result = downloadSong(self.song, self.downloadURL)
-        if result == "dub failure":
-            song['outcome'] = "dub-failure"
-        else:
-            song['outcome'] = "success"
+        job = {'index': 46987, 'song': self.song, 'downloadURL': self.downloadURL}
+        self.assertTrue(downloadStage(job))
+        transcodeStage(job)
+        self.assertEqual(job['song']['outcome'], "success")
 
     # Not currently working properly as tests are interdependent and need to be executed in the correct order (i.e. test api service, and then test downloader)
 
 
+class TestGetSong(unittest.TestCase):
+
+    def test_api_failure_stops_before_download(self):
+        import logging
+        import music_scraper
+        downloads = []
+        patched = {
+            'recordList': [{'trackName': 'Sisyphus', 'artistName': 'Andrew Bird', 'stationName': 'KUTX', 'videoURL': 'abc'}],
+            'debug': logging.getLogger('tests'),
+            'lock': threading.Lock(),
+            'getDownloadURL': lambda song: "API Failed",
+            'fetchSong': lambda *args: downloads.append(args),
+        }
+        saved = {name: getattr(music_scraper, name, None) for name in patched}
+        for name, value in patched.items():
+            setattr(music_scraper, name, value)
+        try:
+            music_scraper.getSong(0)
+            self.assertEqual(music_scraper.recordList[0]['outcome'], "api-failure")
+            self.assertEqual(downloads, [])
+        finally:
+            for name, value in saved.items():
+                setattr(music_scraper, name, value)
+
+class TestPipeline(unittest.TestCase):
+
+    def test_every_item_finishes(self):
+        finished = []
+        failed = []
+
+        def fail_on_seven(i):
+            if i == 7:
+                raise ValueError(i)
+            return True
+
+        pipeline = Pipeline([
+            ('odd', lambda i: i % 2 == 1, 2),
+            ('seven', fail_on_seven, 2),
+            ('sleep', lambda i: time.sleep(0.5) or True, 2),
+        ], on_done=finished.append, on_error=lambda i, e: failed.append(i)).start()
+        start = time.time()
+        for i in range(10):
+            pipeline.submit(i)
+        pipeline.close()
+
+        self.assertEqual(sorted(finished), list(range(10)))
+        self.assertEqual(failed, [7])
+        self.assertEqual(pipeline.in_flight, 0)
+        # (Four songs reach the last stage; its two workers should run them two at a time)
+        self.assertTrue(time.time() - start < 1.5)
+
+class TestHTTPClient(unittest.TestCase):
+
+    def test_throttling_reaches_the_bucket(self):
+        requests_made = []
+
+        class Throttled(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests_made.append(self.path)
+                self.send_response(429)
+                self.send_header('Retry-After', '0')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        server, url = serve(Throttled)
+        try:
+            limiter = RateLimiter(rate=1000, capacity=1000)
+            session = HTTPSession(retries=2, limiter=limiter)
+            response = session.get(url)
+            session.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # (One request per attempt, each of which slowed the host's bucket down)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(len(requests_made), 3)
+        self.assertEqual(limiter.bucket(url).rate, 1000 / 2 ** 3)
+
+class TestDownloadFile(unittest.TestCase):
+
+    # Download from a server that drops the first connection halfway through the file,
+    # returning the file's contents, its hash and the Range headers the server received
+    def download_with_dropped_connection(self, honor_range):
+        import hashlib
+        import re
+        import tempfile
+
+        payload = bytes(range(256)) * 1024
+        ranges = []
+
+        class Dropping(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requested = self.headers.get('Range')
+                ranges.append(requested)
+                if requested is None:
+                    # (Announce the whole file but only send half of it)
+                    self.send_response(200)
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload[:len(payload) // 2])
+                elif honor_range:
+                    start = int(re.match(r'bytes=(\d+)-', requested).group(1))
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(payload) - 1, len(payload)))
+                    self.send_header('Content-Length', str(len(payload) - start))
+                    self.end_headers()
+                    self.wfile.write(payload[start:])
+                else:
+                    self.send_response(200)
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+
+        server, url = serve(Dropping)
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'song.m4a')
+                hasher = hashlib.sha256()
+                self.assertEqual(download_file(url, path, hasher=hasher), path)
+                self.assertFalse(os.path.exists(path + '.part'))
+                with open(path, 'rb') as file:
+                    content = file.read()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(content, payload)
+        self.assertEqual(hasher.hexdigest(), hashlib.sha256(payload).hexdigest())
+        return ranges
+
+    def test_resumes_with_range(self):
+        ranges = self.download_with_dropped_connection(honor_range=True)
+        self.assertEqual(ranges, [None, 'bytes={}-'.format(256 * 1024 // 2)])
+
+    def test_server_ignoring_range(self):
+        ranges = self.download_with_dropped_connection(honor_range=False)
+        self.assertEqual(ranges, [None, 'bytes={}-'.format(256 * 1024 // 2)])
+
+class TestYouTubeSearch(unittest.TestCase):
+
+    def test_results_across_chunks(self):
+        import youtube_search
+
+        def result(videoID, length=None):
+            text = '"videoRenderer":{{"videoId":"{}","title":{{"runs":[]}}'.format(videoID)
+            if length:
+                text += ',"lengthText":{{"accessibility":{{}},"simpleText":"{}"}}'.format(length)
+            return text + '},'
+
+        # (The second result's videoRenderer marker straddles the end of the first chunk,
+        # and the live stream after it has no lengthText of its own)
+        page = 'x' * 1000 + result('first', '3:45')
+        page += 'x' * (youtube_search.CHUNK_SIZE - 10 - len(page)) + result('second', '4:02')
+        page += 'x' * 5000 + result('live') + 'x' * 5000 + result('fourth', '2:10') + 'x' * 50000
+        page = page.encode()
+
+        class Results(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(page)))
+                self.end_headers()
+                self.wfile.write(page)
+
+        server, url = serve(Results)
+        searchURL = youtube_search.SEARCH_URL
+        youtube_search.SEARCH_URL = url + '?search_query={}'
+        try:
+            results = youtube_search.search_videos('song', limit=3, durations=True)
+            self.assertEqual(youtube_search.search_videos('song'), [('first', None)])
+        finally:
+            youtube_search.SEARCH_URL = searchURL
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(results, [('first', 225), ('second', 242), ('live', None)])
+        self.assertEqual(youtube_search.closest_video(results, 240), 'second')
+        self.assertEqual(youtube_search.closest_video(results), 'first')
+        self.assertEqual(youtube_search.closest_video([('live', None)], 240), 'live')
+
+class TestStationAdapters(unittest.TestCase):
+
+    # Feed payloads in each adapter's format for a list of (number, start) plays
+    PAYLOADS = {
+        'KBPA': lambda plays: (
+            '<nowplaying-info-list>' + ''.join(
+                '<nowplaying-info type="track" timestamp="{}">'
+                '<property name="cue_title">Song {}</property><property name="track_artist_name">Artist</property>'
+                '<property name="cue_time_duration">3:00</property><property name="program_id">Mornings</property>'
+                '</nowplaying-info>'.format(start, n) for n, start in plays) + '</nowplaying-info-list>'
+        ).encode(),
+        'W249AR': lambda plays: json.dumps({'data': {'sites': {'find': {'stream': {'amp': {'recentlyPlayed': {'tracks': [
+            {'title': 'Song {}'.format(n), 'artist': {'artistName': 'Artist'}, 'albumName': None, 'trackDuration': 180, 'startTime': start}
+            for n, start in plays]}}}}}}}).encode(),
+        'WQNQHD2': lambda plays: json.dumps({'data': [
+            {'title': 'Song {}'.format(n), 'artist': 'Artist', 'album': None, 'trackDuration': 180, 'startTime': start}
+            for n, start in plays]}).encode(),
+        # (KUTX's playlist is oldest first and its times are strings; the adapter reverses it)
+        'KUTX': lambda plays: json.dumps({'onToday': [{'has_playlist': True, 'playlist': [
+            {'trackName': 'Song {}'.format(n), 'artistName': 'Artist', '_duration': 180000,
+             '_start_time': time.strftime('%m-%d-%Y %H:%M:%S', time.gmtime(start))}
+            for n, start in sorted(plays, key=lambda play: play[1])]}]}).encode(),
+    }
+
+    def test_polls_keep_only_new_plays(self):
+        from station_adapters import ADAPTERS
+        from station_api_scraper import parse_station
+
+        plays = [(n, 1700000000 + 60 * n) for n in range(1, 6)]
+        for name, payload in self.PAYLOADS.items():
+            for order in ['oldest first', 'newest first']:
+                with self.subTest(adapter=name, order=order):
+                    feed = plays if order == 'oldest first' else plays[::-1]
+                    adapter = ADAPTERS[name](name, 'http://localhost/')
+
+                    records, adapter.watermark = parse_station(adapter, payload([play for play in feed if play[0] <= 3]))
+                    self.assertEqual(sorted(record['track'] for record in records), ['Song 1', 'Song 2', 'Song 3'])
+
+                    records, adapter.watermark = parse_station(adapter, payload(feed))
+                    self.assertEqual(sorted(record['track'] for record in records), ['Song 4', 'Song 5'])
+
+                    records, adapter.watermark = parse_station(adapter, payload(feed))
+                    self.assertEqual(records, [])
+
+    def test_conditional_fetch(self):
+        import asyncio
+        import tempfile
+        import aiohttp
+        import station_api_scraper
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+        from station_adapters import ADAPTERS
+
+        payload = self.PAYLOADS['WQNQHD2']([(1, 1700000060)])
+        validators = {'ETag': '"v1"', 'Last-Modified': 'Tue, 14 Nov 2023 22:14:20 GMT'}
+        requests_made = []
+
+        # (Answers 304 when sent its current ETag, and the payload with its validators otherwise)
+        class Feed(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests_made.append((self.headers.get('If-None-Match'), self.headers.get('If-Modified-Since')))
+                if 'ETag' in validators and self.headers.get('If-None-Match') == validators['ETag']:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                for name, value in validators.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        async def fetch(adapter):
+            async with aiohttp.ClientSession() as client:
+                return await adapter.fetch(client)
+
+        # Save one fetched payload through a session on `engine`
+        def save(adapter, content, engine):
+            session = sessionmaker(bind=engine)()
+            records, watermark = station_api_scraper.parse_station(adapter, content)
+            station_api_scraper.save_stations(session, [(adapter, records, watermark)])
+            session.close()
+
+        server, url = serve(Feed)
+        directory = tempfile.TemporaryDirectory()
+        engine = create_engine('sqlite:///' + os.path.join(directory.name, 'songs.sqlite'))
+        station_api_scraper.Base.metadata.create_all(engine)
+        broken = create_engine('sqlite:///' + os.path.join(directory.name, 'empty.sqlite'))
+        engine, station_api_scraper.engine = station_api_scraper.engine, engine
+        station_api_scraper.known_slugs.clear()
+        try:
+            adapter = ADAPTERS['WQNQHD2']('WQNQHD2', url)
+            self.assertEqual(asyncio.run(fetch(adapter)), payload)
+            self.assertEqual(requests_made[-1], (None, None))
+
+            # (Validators are only kept once the payload is saved, so a failed save fetches it again)
+            save(adapter, payload, broken)
+            self.assertEqual((adapter.etag, adapter.last_modified, adapter.payload_hash), (None, None, None))
+            self.assertEqual(asyncio.run(fetch(adapter)), payload)
+            self.assertEqual(requests_made[-1], (None, None))
+
+            save(adapter, payload, station_api_scraper.engine)
+            self.assertEqual((adapter.etag, adapter.last_modified), ('"v1"', validators['Last-Modified']))
+            self.assertIsNotNone(adapter.payload_hash)
+            session = sessionmaker(bind=station_api_scraper.engine)()
+            self.assertEqual(session.get(station_api_scraper.StationState, 'WQNQHD2').etag, '"v1"')
+            session.close()
+
+            # (The saved validators are sent, and a 304 means there's nothing new)
+            self.assertIsNone(asyncio.run(fetch(adapter)))
+            self.assertEqual(requests_made[-1], ('"v1"', validators['Last-Modified']))
+
+            # (A feed without validators is skipped when its payload is byte-identical)
+            validators.clear()
+            self.assertIsNone(asyncio.run(fetch(adapter)))
+            self.assertIsNone(asyncio.run(fetch(adapter)))
+            self.assertEqual(requests_made[-1], (None, None))
+            self.assertEqual(len(requests_made), 5)
+        finally:
+            server.shutdown()
+            server.server_close()
+            station_api_scraper.engine.dispose()
+            broken.dispose()
+            station_api_scraper.engine = engine
+            station_api_scraper.known_slugs.clear()
+            directory.cleanup()
+
+class TestClaimSongs(unittest.TestCase):
+
+    def setUp(self):
+        import logging
+        import tempfile
+        import song_downloader
+        from sqlalchemy import create_engine
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = create_engine('sqlite:///' + os.path.join(self.directory.name, 'songs.sqlite'))
+        song_downloader.Base.metadata.create_all(self.engine)
+        song_downloader.Session.remove()
+        song_downloader.Session.configure(bind=self.engine)
+        song_downloader.debug = logging.getLogger('tests')
+        song_downloader.lock = threading.Lock()
+        song_downloader.HELD_SONGS.clear()
+        song_downloader.DOWNLOADED_KEYS.clear()
+        self.song_downloader = song_downloader
+
+        Song = song_downloader.Song
+        self.session = song_downloader.Session()
+        self.session.add_all([Song(track='Song {}'.format(i), slug='song{}'.format(i), station='KUTX', downloaded=False)
+                              for i in range(5)])
+        self.session.add(Song(track='Other', slug='other', station='KBPA', downloaded=False))
+        self.session.add(Song(track='Done', slug='done', station='KUTX', downloaded=True))
+        self.session.commit()
+
+    def tearDown(self):
+        self.song_downloader.Session.remove()
+        self.song_downloader.Session.configure(bind=self.song_downloader.engine)
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def statuses(self):
+        Song = self.song_downloader.Song
+        return {songID: (status, claimedAt) for songID, status, claimedAt in self.session.query(Song.id, Song.status, Song.claimedAt)}
+
+    def test_claim_and_release(self):
+        song_downloader = self.song_downloader
+        first = song_downloader.claimSongs('KUTX', 3)
+        second = song_downloader.claimSongs('KUTX', 3)
+        self.assertEqual((len(first), len(second)), (3, 2))
+        self.assertEqual(len({song.id for song in first + second}), 5)
+        self.assertEqual(song_downloader.claimSongs('KUTX', 3), [])
+        self.assertEqual({self.statuses()[song.id][0] for song in first + second}, {'processing'})
+
+        # (Released songs can be claimed again)
+        candidates = {'KUTX': first + second}
+        song_downloader.releaseUnusedClaims(candidates)
+        self.assertEqual(candidates, {'KUTX': []})
+        self.assertEqual({status for status, claimedAt in self.statuses().values()}, {None})
+        self.assertEqual(len(song_downloader.claimSongs('KUTX', 10)), 5)
+
+    def test_lost_claims(self):
+        song_downloader = self.song_downloader
+        kept, taken = song_downloader.claimSongs('KUTX', 2)
+
+        # (Another downloader releases and reclaims one of the songs)
+        from sqlalchemy import update
+        self.session.execute(update(song_downloader.Song).where(song_downloader.Song.id == taken.id).values(claimedAt=123))
+        self.session.commit()
+
+        song_downloader.renewClaims()
+        self.assertTrue(taken.claimLost)
+        self.assertFalse(getattr(kept, 'claimLost', False))
+        self.assertEqual(self.statuses()[kept.id], ('processing', kept.lease))
+        self.assertEqual(list(song_downloader.HELD_SONGS), [kept.id])
+
+        for song in [kept, taken]:
+            song.status = 'success'
+            song.downloaded = True
+        song_downloader.saveOutcomes([kept, taken])
+        self.assertEqual(self.statuses()[kept.id][0], 'success')
+        self.assertEqual(self.statuses()[taken.id], ('processing', 123))
+        self.assertEqual(song_downloader.HELD_SONGS, {})
+
+    def test_find_duplicate(self):
+        song_downloader = self.song_downloader
+        Song = song_downloader.Song
+        dreams = Song(track='Dreams', artist='Fleetwood Mac', slug='dreamsfleetwoodmac', station='KUTX',
+                      downloaded=True, similarityKey=similarity_key('Dreams', 'Fleetwood Mac'))
+        self.session.add(dreams)
+        self.session.commit()
+
+        self.assertEqual(song_downloader.findDuplicate(Song(id=100, track='Dreams - 2004 Remaster', artist='Fleetwood Mac')), dreams.id)
+        self.assertIsNone(song_downloader.findDuplicate(dreams))
+        self.assertIsNone(song_downloader.findDuplicate(Song(id=101, track='Dream On', artist='Aerosmith')))
+        self.assertIsNone(song_downloader.findDuplicate(Song(id=102, track=None, artist='Fleetwood Mac')))
+
+        # (Songs downloaded earlier in the run count before their outcome is saved)
+        song_downloader.DOWNLOADED_KEYS[similarity_key('Dream On', 'Aerosmith')] = 103
+        self.assertEqual(song_downloader.findDuplicate(Song(id=104, track='Dream On (Remastered)', artist='Aerosmith')), 103)
+
+class TestSaveStations(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        import station_api_scraper
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = create_engine('sqlite:///' + os.path.join(self.directory.name, 'songs.sqlite'))
+        station_api_scraper.Base.metadata.create_all(self.engine)
+        self.engine, station_api_scraper.engine = station_api_scraper.engine, self.engine
+        station_api_scraper.known_slugs.clear()
+        self.station_api_scraper = station_api_scraper
+        self.session = sessionmaker(bind=station_api_scraper.engine)()
+
+    def tearDown(self):
+        self.session.close()
+        self.station_api_scraper.engine.dispose()
+        self.station_api_scraper.engine = self.engine
+        self.station_api_scraper.known_slugs.clear()
+        self.directory.cleanup()
+
+    # Song records for `plays` (track and artist pairs) from a station
+    def records(self, station, plays):
+        return [{'track': track, 'artist': artist, 'slug': convert_to_slug(track, artist),
+                 'similarityKey': similarity_key(track, artist), 'collection': None, 'duration': 180,
+                 'station': station, 'program': None, 'datePlayed': None} for track, artist in plays]
+
+    # Save one poll of `plays` from a station
+    def save(self, station, plays):
+        from station_adapters import ADAPTERS
+        adapter = ADAPTERS[station](station, 'http://localhost/')
+        self.station_api_scraper.save_stations(self.session, [(adapter, self.records(station, plays), None)])
+
+    def tracks(self):
+        Song = self.station_api_scraper.Song
+        return sorted(track for track, in self.session.query(Song.track))
+
+    def test_near_duplicates(self):
+        self.save('KUTX', [('Dreams', 'Fleetwood Mac'), ('Stay (feat. Justin Bieber)', 'The Kid LAROI'), ('Stay', 'Kid LAROI')])
+        self.assertEqual(self.tracks(), ['Dreams', 'Stay (feat. Justin Bieber)'])
+
+        # (Checked against the saved songs whether or not this process saved them)
+        self.station_api_scraper.known_slugs.clear()
+        self.save('KBPA', [('Dreams - 2004 Remaster', 'Fleetwood Mac'), ('Dreams (Remix)', 'Fleetwood Mac'), ('Dreams', 'Fleetwood Mac')])
+        self.assertEqual(self.tracks(), ['Dreams', 'Dreams (Remix)', 'Stay (feat. Justin Bieber)'])
+
+    def test_insert_or_ignore(self):
+        from metrics import metrics
+        station_api_scraper = self.station_api_scraper
+        saved = lambda: metrics.counters.get(('songs_saved_total', ()), 0)
+
+        before = saved()
+        self.save('KUTX', [('Song 1', 'Artist'), ('Song 2', 'Artist')])
+        self.assertEqual(saved() - before, 2)
+
+        # (Overlapping polls, e.g. from another process that doesn't know these slugs, only add the new songs)
+        station_api_scraper.known_slugs.clear()
+        before = saved()
+        self.save('KBPA', [('Song 2', 'Artist'), ('Song 3', 'Artist')])
+        self.assertEqual(saved() - before, 1)
+        self.assertEqual(self.tracks(), ['Song 1', 'Song 2', 'Song 3'])
+
+        # (Rows whose slug is already in the table are skipped, and left out of the rowcount)
+        records = self.records('KUTX', [('Song 3', 'Artist'), ('Song 4', 'Artist'), ('Song 1', 'Artist')])
+        inserted = self.session.execute(station_api_scraper.insert_new_songs(records)).rowcount
+        self.session.commit()
+        self.assertEqual(inserted, 1)
+        self.assertEqual(self.tracks(), ['Song 1', 'Song 2', 'Song 3', 'Song 4'])
+        Song = station_api_scraper.Song
+        self.assertEqual(self.session.query(Song.station).filter(Song.slug == convert_to_slug('Song 3', 'Artist')).scalar(), 'KBPA')
+
+class TestRecordStore(unittest.TestCase):
+
+    def test_round_trip(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            json_path = os.path.join(directory, 'songRecords.json')
+            with open(json_path, 'w') as json_file:
+                json.dump([{'trackName': 'Sisyphus', 'stationName': 'KUTX'}, {'trackName': 'Holocene', 'outcome': 'success'}], json_file)
+
+            store = RecordStore.open(os.path.join(directory, 'songRecords.sqlite'), json_path)
+            self.assertEqual(len(store), 2)
+            song = store[0]
+            song['outcome'] = 'error'
+            store[0] = song
+
+            reopened = RecordStore.open(os.path.join(directory, 'songRecords.sqlite'), json_path)
+            self.assertEqual(reopened[0], {'trackName': 'Sisyphus', 'stationName': 'KUTX', 'outcome': 'error'})
+            with self.assertRaises(IndexError):
+                reopened[2]
+
+    def test_sample_eligible(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            json_path = os.path.join(directory, 'songRecords.json')
+            with open(json_path, 'w') as json_file:
+                json.dump([
+                    {'trackName': 'Sisyphus', 'stationName': 'KUTX'},
+                    {'trackName': 'Holocene', 'stationName': 'KUTX', 'outcome': 'success'},
+                    {'trackName': 'Gooey', 'stationName': 'KCRW'},
+                    {'trackName': 'Float On', 'stationName': 'KUTX', 'outcome': 'api-failure'},
+                ], json_file)
+
+            store = RecordStore.open(os.path.join(directory, 'songRecords.sqlite'), json_path, excluded_stations=['KCRW'])
+            self.assertEqual(sorted(store.sample(10)), [0, 3])
+            self.assertEqual(len(store.sample(1)), 1)
+
+            song = store[0]
+            song['outcome'] = 'success'
+            store[0] = song
+            self.assertEqual(store.sample(10), [3])
+
+            # (Changing the exclusions re-flags the records)
+            store = RecordStore.open(os.path.join(directory, 'songRecords.sqlite'), json_path, excluded_stations=[])
+            self.assertEqual(sorted(store.sample(10)), [2, 3])
+
+class TestSQLiteCache(unittest.TestCase):
+
+    def test_opens_on_first_use(self):
+        import tempfile
+        from cache import MISSING, SQLiteCache
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.sqlite')
+            cache = SQLiteCache('test', ttl=60, path=path)
+            self.assertFalse(os.path.exists(path))
+
+            self.assertIs(cache.get('missing'), MISSING)
+            cache.set('none', None)
+            cache.set('expired', 1, ttl=-1)
+            self.assertTrue(os.path.exists(path))
+            self.assertIsNone(cache.get('none'))
+            self.assertIs(cache.get('expired'), MISSING)
+            cache.connection().close()
+
+class CopyTranscoder:
+    calls = 0
+
+    def transcode(self, source, destination):
+        import shutil
+        self.calls += 1
+        shutil.copyfile(source, destination)
+
+class TestAudioStore(unittest.TestCase):
+
+    def test_reuses_identical_downloads(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as directory:
+            transcoder = CopyTranscoder()
+            store = AudioStore(transcoder, path=os.path.join(directory, 'cache.sqlite'))
+            paths = [os.path.join(directory, name) for name in ['a.m4a', 'a.mp3', 'b.mp3']]
+            with open(paths[0], 'wb') as file:
+                file.write(b'audio')
+
+            self.assertFalse(store.transcode(paths[0], paths[1], 'digest'))
+            self.assertTrue(store.transcode(paths[0], paths[2], 'digest'))
+            self.assertEqual(transcoder.calls, 1)
+            with open(paths[2], 'rb') as file:
+                self.assertEqual(file.read(), b'audio')
+
+            # (An mp3 that has been deleted is transcoded again)
+            os.remove(paths[1])
+            os.remove(paths[2])
+            self.assertFalse(store.transcode(paths[0], paths[2], 'digest'))
+            self.assertEqual(transcoder.calls, 2)
+
+    def test_duplicates_wait_for_tagging(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = AudioStore(CopyTranscoder(), path=os.path.join(directory, 'cache.sqlite'))
+            paths = [os.path.join(directory, name) for name in ['a.m4a', 'a.mp3', 'b.mp3']]
+            with open(paths[0], 'wb') as file:
+                file.write(b'audio')
+
+            duplicate = threading.Thread(target=store.transcode, args=(paths[0], paths[2], 'digest'))
+            with store.lock_for('digest'):
+                store.transcode(paths[0], paths[1], 'digest')
+                duplicate.start()
+                duplicate.join(0.2)
+                self.assertTrue(duplicate.is_alive())
+
+                # (Tagging rewrites the mp3 while the duplicate waits)
+                with open(paths[1], 'wb') as file:
+                    file.write(b'tagged audio')
+            duplicate.join()
+
+            with open(paths[2], 'rb') as file:
+                self.assertEqual(file.read(), b'tagged audio')
+
+class TestMetrics(unittest.TestCase):
+
+    def test_export(self):
+        metrics = Metrics()
+        metrics.increment('songs_total', status='success', station='KUTX')
+        metrics.increment('songs_total', status='success', station='KUTX')
+        metrics.observe('pipeline_stage_seconds', 0.3, stage='download')
+        metrics.observe('pipeline_stage_seconds', 7, stage='download')
+
+        text = metrics.prometheus()
+        self.assertIn('songs_total{station="KUTX",status="success"} 2', text)
+        self.assertIn('pipeline_stage_seconds_bucket{stage="download",le="0.5"} 1', text)
+        self.assertIn('pipeline_stage_seconds_bucket{stage="download",le="+Inf"} 2', text)
+        self.assertIn('pipeline_stage_seconds_count{stage="download"} 2', text)
+
+        histogram = metrics.summary()['histograms'][0]
+        self.assertEqual((histogram['count'], histogram['p50'], histogram['max']), (2, 0.5, 7))
+
+class TestNormalization(unittest.TestCase):
+
+    def test_slug(self):
+        self.assertEqual(convert_to_slug("The Less I Know the Better", "Tame Impala"), "lessiknowbettertameimpala")
+        self.assertEqual(convert_to_slug("Theory of Everything", "The Killers"), "theoryofeverythingkillers")
+        self.assertEqual(convert_to_slug("Everybody Wants to Rule the World", "Tears for Fears"), "everybodywantstoruletearsforfears")
+
+    def test_duration(self):
+        self.assertEqual(convert_duration("3:45"), 225)
+        self.assertEqual(convert_duration("1:02:33"), 3753)
+        self.assertEqual(convert_duration("215"), 215)
+        self.assertIsNone(convert_duration("n/a"))
+
+class TestSimilarity(unittest.TestCase):
+
+    def test_near_duplicates(self):
+        self.assertEqual(similarity_key("Dreams - 2004 Remaster", "Fleetwood Mac"), similarity_key("Dreams", "Fleetwood Mac"))
+        self.assertEqual(similarity_key("Stay (feat. Justin Bieber)", "Kid LAROI"), similarity_key("Stay", "The Kid LAROI"))
+        self.assertNotEqual(similarity_key("Dream On", "Aerosmith"), similarity_key("Dreams", "Fleetwood Mac"))
+        self.assertNotEqual(similarity_key("Stay", "Zedd"), similarity_key("Stay", "The Kid LAROI"))
+
+    def test_distinct_recordings(self):
+        def distinct(first, second, artist):
+            self.assertNotEqual(similarity_key(first, artist), similarity_key(second, artist))
+        distinct("Everybody Wants to Rule the World", "Everybody Wants to Rule the World (Remix)", "Tears for Fears")
+        distinct("Symphony No. 5 in C Minor, Op. 67: II. Andante con moto",
+                 "Symphony No. 5 in C Minor, Op. 67: I. Allegro con brio", "Ludwig van Beethoven")
+        distinct("Symphony No. 5 in C Minor, Op. 67: II. Andante con moto",
+                 "Symphony No. 5 in C Minor, Op. 67: II. Andante con moto (Part 2)", "Ludwig van Beethoven")
+        distinct("Track 1", "Track 2", "Godspeed You! Black Emperor")
+        self.assertIsNone(similarity_key(None, "Tears for Fears"))
+
 
 if __name__ == '__main__':
     unittest.main()
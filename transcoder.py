@@ -0,0 +1,71 @@
+import os
+import subprocess
+import threading
+import time
+from metrics import metrics
+
+
+class Transcoder:
+    """Converts downloaded m4a files to mp3 with ffmpeg, several at a time.
+
+    Each conversion is a file-to-file ffmpeg process, which decodes and encodes
+    the stream in small frames, so memory per job stays flat however long the
+    track is (pydub used to decode the whole track into PCM in Python first).
+    Up to `workers` conversions run at once, one per CPU by default.
+
+    `bitrate` sets a constant encoder bitrate (e.g. '192k'); `quality` instead
+    selects LAME's VBR quality (0 best - 9 smallest).  A conversion still running
+    after `timeout` seconds is killed.
+
+    Settings can be given in an optional [transcoder] section of credentials.ini
+    (workers, bitrate, quality, timeout).
+    """
+
+    def __init__(self, workers=None, bitrate='192k', quality=None, timeout=300):
+        self.workers = workers or os.cpu_count()
+        self.bitrate = bitrate
+        self.quality = quality
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(self.workers)
+
+    @classmethod
+    def from_config(cls, config):
+        if not config.has_section('transcoder'):
+            return cls()
+        section = config['transcoder']
+        return cls(
+            workers=section.getint('workers', fallback=None),
+            bitrate=section.get('bitrate', fallback='192k'),
+            quality=section.getint('quality', fallback=None),
+            timeout=section.getfloat('timeout', fallback=300),
+        )
+
+    def command(self, source, destination):
+        command = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-i', source, '-vn', '-codec:a', 'libmp3lame']
+        # (A VBR quality setting takes precedence over a constant bitrate)
+        if self.quality is not None:
+            command += ['-q:a', str(self.quality)]
+        else:
+            command += ['-b:a', self.bitrate]
+        return command + ['-f', 'mp3', destination]
+
+    # Convert one file, raising RuntimeError if ffmpeg fails and subprocess.TimeoutExpired
+    # if it takes longer than `timeout`.  The mp3 is written under a temporary name and
+    # renamed when complete, so a failed job never leaves a partial file behind.
+    # (Time spent waiting for a free slot and time spent encoding are recorded separately)
+    def transcode(self, source, destination):
+        partPath = destination + '.part'
+        start = time.monotonic()
+        with self.slots, metrics.timer('transcode_seconds'):
+            metrics.observe('transcode_slot_wait_seconds', time.monotonic() - start)
+            try:
+                result = subprocess.run(self.command(source, partPath), stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.PIPE, timeout=self.timeout)
+                if result.returncode != 0:
+                    raise RuntimeError("ffmpeg exited with code {}: {}".format(
+                        result.returncode, result.stderr.decode(errors='replace').strip()))
+                os.replace(partPath, destination)
+            finally:
+                if os.path.exists(partPath):
+                    os.remove(partPath)
+        return destination
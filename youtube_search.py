@@ -0,0 +1,66 @@
+import re
+from http_client import client
+from normalization import convert_duration
+
+
+SEARCH_URL = 'https://www.youtube.com/results?search_query={}'
+
+# Bytes of the results page read at a time
+CHUNK_SIZE = 16 * 1024
+
+VIDEO_PATTERN = re.compile(rb'"videoRenderer":{"videoId":"(.*?)"')
+LENGTH_PATTERN = re.compile(rb'"lengthText":{.*?"simpleText":"([\d:]+)"', re.DOTALL)
+
+# (Bytes at the end of the buffer that are searched again with the next chunk,
+# in case a videoRenderer marker was split between two chunks)
+OVERLAP = 128
+
+
+def search_videos(query, limit=1, durations=False):
+    """Return up to `limit` (videoId, duration) pairs from a YouTube results page, best match first.
+
+    The page is read in chunks and the download stops as soon as enough results
+    have been found, instead of fetching the whole multi-hundred-KB page and then
+    searching it.  With `durations`, each result's length in seconds is read from
+    its videoRenderer (None if it has none, e.g. live streams); this needs the
+    start of the following result too, so a little more of the page is read.
+    Without it, durations are None.  `query` must already be URL-encoded.
+    """
+    buffer = bytearray()
+    matches = []
+    scan = 0
+
+    # (Stop once the last wanted result is known to be complete)
+    wanted = limit + 1 if durations else limit
+
+    with client.get(SEARCH_URL.format(query), stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            buffer += chunk
+            for match in VIDEO_PATTERN.finditer(buffer, scan):
+                matches.append((match.group(1).decode(), match.start(), match.end()))
+                scan = match.end()
+            scan = max(scan, len(buffer) - OVERLAP)
+            if len(matches) >= wanted:
+                break
+
+    results = []
+    for i, (videoID, start, end) in enumerate(matches[:limit]):
+        duration = None
+        if durations:
+            # (A result's fields run up to where the next result starts)
+            nextStart = matches[i + 1][1] if i + 1 < len(matches) else len(buffer)
+            length = LENGTH_PATTERN.search(buffer, end, nextStart)
+            if length:
+                duration = convert_duration(length.group(1).decode())
+        results.append((videoID, duration))
+    return results
+
+
+# Choose the result whose length is closest to `duration` (seconds), or the top result
+# if the song's duration is unknown or no result has a length
+def closest_video(results, duration=None):
+    timed = [(videoID, length) for videoID, length in results if length is not None]
+    if not duration or not timed:
+        return results[0][0]
+    return min(timed, key=lambda result: abs(result[1] - duration))[0]